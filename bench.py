@@ -0,0 +1,464 @@
+"""Painnoll bot uchun yuklama / replay benchmark.
+
+Sintetik Update oqimi (registratsiya, konsultatsiya matnlari, eslatma
+tugmalari rd:<id> / rs:<id> va eski "done" / "remind_later", hamda
+send_due_reminders eslatma to'lqini) botning
+o'z handlerlari orqali o'tkaziladi. Tashqi so'rovlar lokal Bot API
+o'rinbosariga boradi: u kechikish va 429 javoblarini qo'sha oladi.
+
+Misollar:
+    python bench.py --users 200 --updates 5000
+    python bench.py --mode webhook --storm --save-baseline bench_baseline.json
+    python bench.py --baseline bench_baseline.json --max-regression 0.2
+
+--baseline bilan ishga tushirilganda natija yomonlashsa 1 kodi bilan chiqadi.
+"""
+import argparse
+import collections
+import http.client
+import json
+import logging
+import os
+import random
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+CONSULT_TEXTS = [
+    "Oshqozonim og'riyapti, nima qilay?",
+    "Bo'g'imlarim qattiq og'riydi",
+    "Qon bosimim ko'tariladi",
+    "Qand miqdori yuqori",
+    "Vazn tashlamoqchiman",
+    "Salom, maslahat kerak",
+    "Kechasi yaxshi uxlay olmayapman",
+]
+LABELS = ["Ertalab", "Tushlik", "Kechqurun"]
+# Eski xabarlardagi tugmalar ulushi
+LEGACY_CALLBACK_SHARE = 0.1
+
+class MockBotAPI:
+    """Bot API o'rinbosari: har bir so'rovga sun'iy kechikish va ixtiyoriy 429."""
+
+    def __init__(self, latency_ms: float, jitter_ms: float, error_rate: float, retry_after: int):
+        self.latency = latency_ms / 1000.0
+        self.jitter = jitter_ms / 1000.0
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.calls = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._message_id = 0
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self.server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server.server_address[1]}/bot{{0}}/{{1}}"
+
+    def start(self):
+        threading.Thread(target=self.server.serve_forever, name="mock-api", daemon=True).start()
+
+    def stop(self):
+        self.server.shutdown()
+
+    def _respond(self, method: str, params: dict):
+        with self._lock:
+            self.calls += 1
+            self._message_id += 1
+            message_id = self._message_id
+            fail = random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+        if fail:
+            return 429, {
+                "ok": False,
+                "error_code": 429,
+                "description": f"Too Many Requests: retry after {self.retry_after}",
+                "parameters": {"retry_after": self.retry_after},
+            }
+        if method.startswith(("send", "edit")):
+            chat_id = int((params.get("chat_id") or ["0"])[0])
+            result = {
+                "message_id": message_id,
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "text": (params.get("text") or [""])[0],
+            }
+        else:
+            result = True
+        return 200, {"ok": True, "result": result}
+
+    def _handler(self):
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # Sarlavha va tana alohida yuboriladi: Nagle + delayed ACK ~40ms qo'shmasin
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    self.rfile.read(length)
+                url = urlparse(self.path)
+                status, payload = api._respond(url.path.rsplit("/", 1)[-1], parse_qs(url.query))
+                body = json.dumps(payload).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            do_GET = do_POST = _serve
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+class Workload:
+    """Har bir virtual foydalanuvchi uchun ssenariy: avval registratsiya, keyin aralash trafik."""
+
+    def __init__(self, bot, users: int, consult_share: float, seed: int):
+        self.bot = bot
+        self.rng = random.Random(seed)
+        self.consult_share = consult_share
+        self.users = [10_000 + i for i in range(users)]
+        self.scripts = {cid: self._registration(cid) for cid in self.users}
+        self._update_id = 0
+
+    def _registration(self, cid: int):
+        return [
+            "/start",
+            "🩺 Registratsiya",
+            f"User{cid}",
+            str(self.rng.randint(20, 70)),
+            str(self.rng.randint(50, 110)),
+            str(self.rng.randint(150, 195)),
+            self.rng.choice(self.bot.ISSUES),
+            self.rng.choice(list(self.bot.PRODUCT_BUTTONS)),
+            "📞 Bog'lanish",
+        ]
+
+    def seed(self):
+        """Foydalanuvchilarni registratsiya ssenariysidagi qiymatlar bilan bazaga oldindan yozadi."""
+        with self.bot.db_tx():
+            for cid in self.users:
+                _, _, name, age, weight, height, issue, product, _ = self.scripts[cid]
+                self.bot.add_user(cid, name, int(age), int(weight), int(height), self.bot.PRODUCT_BUTTONS[product], issue)
+
+    def _next_id(self) -> int:
+        self._update_id += 1
+        return self._update_id
+
+    def message(self, cid: int, text: str) -> dict:
+        uid = self._next_id()
+        return {
+            "update_id": uid,
+            "message": {
+                "message_id": uid,
+                "date": int(time.time()),
+                "chat": {"id": cid, "type": "private"},
+                "from": {"id": cid, "is_bot": False, "first_name": f"User{cid}"},
+                "text": text,
+            },
+        }
+
+    def callback(self, cid: int, action: str) -> dict:
+        uid = self._next_id()
+        label = self.rng.choice(LABELS)
+        if self.rng.random() < LEGACY_CALLBACK_SHARE:
+            data = "done" if action == "d" else "remind_later"
+        else:
+            # Eslatma yuborilgandek: yozuv ochiladi, tugmada uning id si
+            data = f"r{action}:{self.bot.open_reminders([cid], label)[cid]}"
+        return {
+            "update_id": uid,
+            "callback_query": {
+                "id": str(uid),
+                "chat_instance": str(cid),
+                "from": {"id": cid, "is_bot": False, "first_name": f"User{cid}"},
+                "data": data,
+                "message": {
+                    "message_id": uid,
+                    "date": int(time.time()),
+                    "chat": {"id": cid, "type": "private"},
+                    "text": f"🌿 Assalomu alaykum!\n\n{label} tavsiya:\n",
+                },
+            },
+        }
+
+    def __iter__(self):
+        while True:
+            cid = self.rng.choice(self.users)
+            script = self.scripts[cid]
+            if script:
+                yield self.message(cid, script.pop(0))
+            elif self.rng.random() < self.consult_share:
+                yield self.message(cid, self.rng.choice(CONSULT_TEXTS))
+            else:
+                yield self.callback(cid, self.rng.choice("dds"))
+
+def percentile(values, p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+def histogram_summary(bot, name: str):
+    count = 0
+    total = 0.0
+    buckets = [0] * (len(bot.metrics.BUCKETS) + 1)
+    with bot.metrics._lock:
+        for (hname, _), h in bot.metrics._hists.items():
+            if hname != name:
+                continue
+            for i, n in enumerate(h[:-1]):
+                buckets[i] += n
+            count += sum(h[:-1])
+            total += h[-1]
+    p99 = 0.0
+    acc = 0
+    for le, n in zip(bot.metrics.BUCKETS + (float("inf"),), buckets):
+        acc += n
+        if count and acc >= 0.99 * count:
+            p99 = le
+            break
+    return count, total, p99
+
+def counter_total(bot, name: str) -> float:
+    with bot.metrics._lock:
+        return sum(v for (n, _), v in bot.metrics._counters.items() if n == name)
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class WebhookClient:
+    def __init__(self, port: int, threads: int):
+        self.port = port
+        self.queue = collections.deque()
+        self.cond = threading.Condition()
+        self.rejected = 0
+        self.ack_latency = []
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(threads)]
+
+    def start(self):
+        for t in self._threads:
+            t.start()
+
+    def submit(self, data: dict):
+        with self.cond:
+            self.queue.append(data)
+            self.cond.notify()
+
+    def _work(self):
+        conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=30)
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                data = self.queue.popleft()
+            body = json.dumps(data).encode("utf-8")
+            while True:
+                t = time.perf_counter()
+                conn.request("POST", "/webhook", body, {"Content-Type": "application/json"})
+                resp = conn.getresponse()
+                resp.read()
+                self.ack_latency.append(time.perf_counter() - t)
+                if resp.status != 503:
+                    break
+                # Telegram kabi: navbat to'la bo'lsa keyinroq qayta yuborish
+                self.rejected += 1
+                time.sleep(0.05)
+
+def run(args) -> dict:
+    workdir = tempfile.mkdtemp(prefix="painnoll-bench-")
+    os.environ.setdefault("BOT_TOKEN", "123456:bench")
+    os.environ["DB_PATH"] = os.path.join(workdir, "bench.db")
+    os.environ["UPDATE_WORKERS"] = str(args.workers)
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+    api = MockBotAPI(args.api_latency_ms, args.api_jitter_ms, args.error_rate, args.retry_after)
+    api.start()
+
+    import bot as app
+    from telebot import apihelper
+
+    logging.getLogger().setLevel(logging.DEBUG if args.verbose else logging.CRITICAL)
+    apihelper.API_URL = api.url
+    app.send_limiter = app.RateLimiter(args.send_rate, app.SEND_CHAT_INTERVAL)
+    app.init_db()
+    app.scheduler.start(paused=True)
+
+    started = {}
+    latencies = []
+    process = app.bot.process_new_updates
+
+    def timed_process(updates):
+        try:
+            process(updates)
+        finally:
+            now = time.perf_counter()
+            for u in updates:
+                t0 = started.pop(u.update_id, None)
+                if t0 is not None:
+                    latencies.append(now - t0)
+
+    app.bot.process_new_updates = timed_process
+    app.dispatcher.start()
+
+    if args.mode == "webhook":
+        import uvicorn
+
+        port = free_port()
+        server = uvicorn.Server(uvicorn.Config(app.create_app(), host="127.0.0.1", port=port, log_level="warning"))
+        threading.Thread(target=server.run, name="uvicorn", daemon=True).start()
+        while not server.started:
+            time.sleep(0.01)
+        client = WebhookClient(port, args.clients)
+        client.start()
+        submit = client.submit
+    else:
+        client = None
+
+        def submit(data):
+            app.dispatcher.submit(data, block=True)
+
+    workload = Workload(app, args.users, args.consult_share, args.seed)
+    if args.storm:
+        # To'lqin registratsiyalar tugashini kutmasdan hamma --users ni qamrashi uchun
+        workload.seed()
+    workload = iter(workload)
+    storm = {}
+
+    def reminder_storm():
+        # Hamma foydalanuvchining eslatmasi bir vaqtga to'g'ri kelgan holat
+        with app.db_tx() as conn:
+            storm["users"] = conn.execute("UPDATE users SET next_fire_at = ?", (time.time() - 1,)).rowcount
+        t = time.perf_counter()
+        app.send_due_reminders()
+        storm["seconds"] = time.perf_counter() - t
+
+    storm_thread = None
+    interval = 1.0 / args.rate if args.rate else 0.0
+    t_start = time.perf_counter()
+    for i in range(args.updates):
+        if args.storm and storm_thread is None and i >= args.updates // 2:
+            storm_thread = threading.Thread(target=reminder_storm, name="storm", daemon=True)
+            storm_thread.start()
+        data = next(workload)
+        started[data["update_id"]] = time.perf_counter()
+        submit(data)
+        if interval:
+            delay = t_start + (i + 1) * interval - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+
+    deadline = time.perf_counter() + args.timeout
+    while len(latencies) < args.updates and time.perf_counter() < deadline:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - t_start
+    if storm_thread is not None:
+        storm_thread.join(max(0.0, deadline - time.perf_counter()))
+
+    db_count, db_total, db_p99 = histogram_summary(app, "db_query_seconds")
+    result = {
+        "mode": args.mode,
+        "workers": args.workers,
+        "updates": args.updates,
+        "processed": len(latencies),
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_sec": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(max(latencies, default=0.0) * 1000, 2),
+        "api_calls": api.calls,
+        "api_429": api.errors,
+        "db_queries": db_count,
+        "db_time_s": round(db_total, 3),
+        "db_p99_le_s": db_p99,
+        "db_errors": counter_total(app, "db_errors_total"),
+        "update_errors": counter_total(app, "update_errors_total"),
+    }
+    if client is not None:
+        result["webhook_503"] = client.rejected
+        result["ack_p99_ms"] = round(percentile(client.ack_latency, 99) * 1000, 2)
+    if args.storm:
+        result["storm_users"] = storm.get("users", 0)
+        result["storm_s"] = round(storm.get("seconds", float("nan")), 3)
+    api.stop()
+    return result
+
+def check_regression(result: dict, baseline: dict, max_regression: float):
+    failures = []
+    if result["updates_per_sec"] < baseline["updates_per_sec"] * (1 - max_regression):
+        failures.append(f"updates/sec {result['updates_per_sec']} < baseline {baseline['updates_per_sec']}")
+    if result["p99_ms"] > baseline["p99_ms"] * (1 + max_regression):
+        failures.append(f"p99 {result['p99_ms']}ms > baseline {baseline['p99_ms']}ms")
+    if "storm_s" in result and "storm_s" in baseline:
+        if result["storm_s"] > baseline["storm_s"] * (1 + max_regression):
+            failures.append(f"storm {result['storm_s']}s > baseline {baseline['storm_s']}s")
+        if result["storm_users"] < baseline["storm_users"]:
+            failures.append(f"storm reached {result['storm_users']} users < baseline {baseline['storm_users']}")
+    if result["processed"] < result["updates"]:
+        failures.append(f"only {result['processed']}/{result['updates']} updates processed")
+    return failures
+
+def main(argv=None) -> int:
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--mode", choices=["direct", "webhook"], default="direct",
+                   help="direct: dispatcher.submit; webhook: FastAPI /webhook orqali")
+    p.add_argument("--users", type=int, default=200)
+    p.add_argument("--updates", type=int, default=3000)
+    p.add_argument("--rate", type=float, default=0,
+                   help="yangilanish/s (0 = imkon qadar tez; kechikishni o'lchash uchun to'yinishdan past qiymat bering)")
+    p.add_argument("--workers", type=int, default=4, help="UPDATE_WORKERS")
+    p.add_argument("--clients", type=int, default=8, help="webhook rejimida parallel HTTP mijozlar")
+    p.add_argument("--consult-share", type=float, default=0.6, help="registratsiyadan keyingi matnlar ulushi")
+    p.add_argument("--storm", action="store_true", help="o'rtada send_due_reminders to'lqinini ishga tushirish")
+    p.add_argument("--send-rate", type=float, default=1000, help="eslatmalar uchun RateLimiter tezligi")
+    p.add_argument("--api-latency-ms", type=float, default=20)
+    p.add_argument("--api-jitter-ms", type=float, default=10)
+    p.add_argument("--error-rate", type=float, default=0.0, help="429 javoblari ulushi")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--timeout", type=float, default=120)
+    p.add_argument("--seed", type=int, default=1)
+    p.add_argument("--baseline", help="solishtirish uchun JSON natija")
+    p.add_argument("--max-regression", type=float, default=0.2)
+    p.add_argument("--save-baseline", help="natijani JSON faylga yozish")
+    p.add_argument("--verbose", action="store_true")
+    args = p.parse_args(argv)
+
+    baseline_path = os.path.abspath(args.baseline) if args.baseline else None
+    save_path = os.path.abspath(args.save_baseline) if args.save_baseline else None
+    result = run(args)
+    for k, v in result.items():
+        print(f"{k:>16}: {v}")
+    if save_path:
+        with open(save_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2)
+    if baseline_path:
+        with open(baseline_path, encoding="utf-8") as f:
+            failures = check_regression(result, json.load(f), args.max_regression)
+        for msg in failures:
+            print(f"REGRESSION: {msg}")
+        if failures:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
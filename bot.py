@@ -1,18 +1,92 @@
 import os
+import atexit
+import bisect
+import csv
+import gzip
+import io
+import functools
+import html
+import json
 import logging
+import multiprocessing
+import queue
+import socket
 import sqlite3
-from datetime import datetime, timedelta
+import string
+import tempfile
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 import telebot
 import time
+from concurrent.futures import ThreadPoolExecutor
 from telebot import types
-from apscheduler.schedulers.background import BackgroundScheduler
+from telebot import apihelper
+from telebot.apihelper import ApiTelegramException
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 if not BOT_TOKEN:
     raise RuntimeError("BOT_TOKEN env kerak. Iltimos muhitda sozlang.")
 ADMIN_IDS = [851458432]
-DB_PATH = "painnoll_bot.db"
+DB_PATH = os.getenv("DB_PATH", "painnoll_bot.db")
 TIMEZONE_OFFSET = 0
+# Telegram cheklovlari: umumiy ~30 xabar/s, bitta chatga ~1 xabar/s
+SEND_RATE = 25
+SEND_CHAT_INTERVAL = 1.0
+SENDER_THREADS = 8
+BROADCAST_CHUNK = 100
+BROADCAST_REPORT_SECONDS = 5
+BROADCAST_POLL_SECONDS = 5
+REMINDER_SLOTS = [(8, "Ertalab"), (13, "Tushlik"), (19, "Kechqurun")]
+# Foydalanuvchi vaqt mintaqasini tanlamagan bo'lsa (daqiqa, UTC ga nisbatan).
+# Avvalgi xatti-harakat saqlanadi: soatlar server vaqti + TIMEZONE_OFFSET bo'yicha.
+DEFAULT_TZ_MINUTES = int(os.getenv(
+    "DEFAULT_TZ_MINUTES",
+    str(int(datetime.now().astimezone().utcoffset().total_seconds() // 60) - TIMEZONE_OFFSET * 60),
+))
+# Muddati kelgan eslatmalar shu oraliqda users.next_fire_at indeksidan olinadi
+REMINDER_TICK_SECONDS = 30
+SLOT_CHUNK = 200
+# Bitta tick shundan uzoq ishlamaydi; qolgan qatorlar keyingi tickda olinadi
+SLOT_WINDOW_SECONDS = 5 * 60
+# Kechikkan ishga tushirishlar: shu muddatdan kech bo'lsa o'tkazib yuboriladi
+SLOT_MISFIRE_GRACE = 30 * 60
+SNOOZE_MISFIRE_GRACE = 6 * 60 * 60
+SNOOZE_MINUTES = 30
+# Bitta eslatmani necha marta va bir kunda jami necha marta kechiktirish mumkin
+SNOOZE_MAX = 3
+SNOOZE_DAILY_MAX = 6
+# Xom progress qatorlari shuncha kun saqlanadi; statistikalar progress_daily
+# va progress_totals dan olinadi, ular esa uzoqroq turadi
+PROGRESS_RETENTION_DAYS = int(os.getenv("PROGRESS_RETENTION_DAYS", "90"))
+PROGRESS_DAILY_RETENTION_DAYS = int(os.getenv("PROGRESS_DAILY_RETENTION_DAYS", "730"))
+PRUNE_BATCH = 2000
+VACUUM_PAGES = 500
+MAINTENANCE_HOUR = 3
+ADMIN_PAGE_SIZE = 20
+EXPORT_CHUNK = 1000
+USER_CACHE_SIZE = 5000
+USER_CACHE_TTL = 300
+# Tugallanmagan suhbat holati (registratsiya, anons) shu muddatdan keyin unutiladi
+STATE_TTL = 24 * 60 * 60
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "4"))
+# >1 bo'lsa yangilanishlar chat_id bo'yicha shuncha jarayonga taqsimlanadi
+WORKER_PROCESSES = int(os.getenv("WORKER_PROCESSES", "1"))
+# Eslatma va anonslarni faqat lease egasi (lider) yuboradi
+LEASE_TTL = 30
+UPDATE_QUEUE_SIZE = 500
+# Telegram qayta yuborgan yangilanishlar shu oyna ichida bir marta bajariladi
+SEEN_TTL = 60 * 60
+SEEN_MAX = 50000
+SEEN_FLUSH_SECONDS = 1.0
+ALLOWED_UPDATES = ["message", "callback_query"]
+# Polling rejimida /metrics uchun alohida port (0 = o'chiq)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+# Ishchi jarayonlar o'z metrikalarini asosiy jarayonga shu oraliqda yuboradi
+METRICS_PUSH_SECONDS = 5
+# Ixtiyoriy: mavzular va javob shablonlari JSON fayldan (DEFAULT_INTENTS formatida)
+INTENTS_PATH = os.getenv("INTENTS_PATH", "intents.json")
 
 logging.basicConfig(
     level=logging.INFO,
@@ -22,8 +96,38 @@ logging.basicConfig(
         logging.FileHandler("bot.log", encoding="utf-8"),
     ],
 )
-bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML")
-scheduler = BackgroundScheduler()
+# Handlerlar UpdateDispatcher oqimlarida bajariladi (threaded=False),
+# shunda bitta chat yangilanishlari tartibi saqlanadi.
+bot = telebot.TeleBot(BOT_TOKEN, parse_mode="HTML", threaded=False)
+class LazyScheduler:
+    """APScheduler (va SQLAlchemy) birinchi murojaatda yuklanadi.
+
+    Ishlar (eslatmalar tick'i, "Keyinroq eslat") shu bazada saqlanadi va
+    qayta ishga tushganda yo'qolmaydi. Bir nechta o'tkazib yuborilgan
+    ishga tushirish bittaga birlashtiriladi (coalesce).
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._scheduler = None
+
+    def get(self):
+        if self._scheduler is None:
+            with self._lock:
+                if self._scheduler is None:
+                    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+                    from apscheduler.schedulers.background import BackgroundScheduler
+
+                    self._scheduler = BackgroundScheduler(
+                        jobstores={"default": SQLAlchemyJobStore(url=f"sqlite:///{DB_PATH}", tablename="scheduler_jobs")},
+                        job_defaults={"coalesce": True, "max_instances": 1, "misfire_grace_time": SLOT_MISFIRE_GRACE},
+                    )
+        return self._scheduler
+
+    def __getattr__(self, name):
+        return getattr(self.get(), name)
+
+scheduler = LazyScheduler()
 
 main_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
 main_kb.add(types.KeyboardButton("📝 Mening profilim"), types.KeyboardButton("🍽 Ovqatlanish"))
@@ -45,19 +149,241 @@ issue_kb.add(types.KeyboardButton("🧔 Prostata"))
 issue_kb.add(types.KeyboardButton("🍋 Detoks / vazn"))
 issue_kb.add(types.KeyboardButton("⬅️ Orqaga"))
 
+PRODUCT_BUTTONS = {"🌿 Painnoll": "Painnoll", "🍃 BioDetox": "BioDetox", "💪 VitaPro": "VitaPro", "🔬 NutraMax": "NutraMax"}
+PRODUCTS = list(PRODUCT_BUTTONS.values())
+ISSUES = ["🦵 Suyak va bo'g'imlar", "🍽 Oshqozon / hazm", "🧔 Prostata", "🍋 Detoks / vazn"]
+
+# Eslatma tugmalari: rd:<id> (bajarildi), rs:<id> (keyinroq), id reminders jadvalidan
 daily_inline = types.InlineKeyboardMarkup()
 daily_inline.add(
-    types.InlineKeyboardButton("✅ Amal bajarildi", callback_data="done"),
-    types.InlineKeyboardButton("⏰ Keyinroq eslat", callback_data="remind_later"),
+    types.InlineKeyboardButton("✅ Amal bajarildi", callback_data="rd:#RID"),
+    types.InlineKeyboardButton("⏰ Keyinroq eslat", callback_data="rs:#RID"),
 )
 
+class FrozenMarkup(types.JsonSerializable):
+    """O'zgarmas klaviatura: JSON bir marta tayyorlanadi, har yuborishda qayta emas."""
+
+    def __init__(self, markup):
+        self.json = markup.to_json()
+
+    def to_json(self):
+        return self.json
+
+main_kb = FrozenMarkup(main_kb)
+product_kb = FrozenMarkup(product_kb)
+issue_kb = FrozenMarkup(issue_kb)
+daily_inline = FrozenMarkup(daily_inline)
+
+def daily_markup(reminder_id: int) -> str:
+    return daily_inline.json.replace("#RID", str(reminder_id))
+
+class Metrics:
+    """Prometheus matn formatidagi yengil hisoblagichlar, gistogrammalar va gauge'lar."""
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._hists = {}
+        self._gauges = {}
+        # Qiymati boshqa joyda o'sib boradigan hisoblagichlar (masalan kesh hits)
+        self._counter_fns = {}
+        # Ishchi jarayonlardan kelgan oxirgi holat: {worker: (counters, hists, gauges)}
+        self._remote = {}
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [0] * (len(self.BUCKETS) + 1) + [0.0]
+            h[bisect.bisect_left(self.BUCKETS, value)] += 1
+            h[-1] += value
+
+    def gauge(self, name: str, fn):
+        self._gauges[name] = fn
+
+    def counter(self, name: str, fn):
+        self._counter_fns[name] = fn
+
+    @staticmethod
+    def _labels(pairs, extra=()) -> str:
+        items = list(pairs) + list(extra)
+        if not items:
+            return ""
+        return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+    def snapshot(self):
+        """Jarayon ichidagi qiymatlar nusxasi (pickle qilinadi, boshqa jarayonga yuboriladi)."""
+        with self._lock:
+            counters = dict(self._counters)
+            hists = {k: list(v) for k, v in self._hists.items()}
+        for name, fn in self._counter_fns.items():
+            try:
+                counters[(name, ())] = fn()
+            except Exception:
+                continue
+        gauges = {}
+        for name, fn in self._gauges.items():
+            try:
+                gauges[name] = fn()
+            except Exception:
+                continue
+        return counters, hists, gauges
+
+    def merge(self, worker, snapshot):
+        with self._lock:
+            self._remote[worker] = snapshot
+
+    def render(self) -> str:
+        # Ishchilar qiymatlari worker="<n>" yorlig'i bilan, har bir metrika bitta blokda
+        with self._lock:
+            remote = sorted(self._remote.items())
+        sources = [(self.snapshot(), ())] + [(snap, (("worker", str(w)),)) for w, snap in remote]
+        counters, hists, gauges = {}, {}, {}
+        for (c, h, g), extra in sources:
+            for (name, labels), value in c.items():
+                counters.setdefault(name, []).append((labels + extra, value))
+            for (name, labels), value in h.items():
+                hists.setdefault(name, []).append((labels + extra, value))
+            for name, value in g.items():
+                gauges.setdefault(name, []).append((extra, value))
+        lines = []
+        for name, samples in sorted(counters.items()):
+            lines.append(f"# TYPE {name} counter")
+            for labels, value in sorted(samples):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        for name, samples in sorted(hists.items()):
+            lines.append(f"# TYPE {name} histogram")
+            for labels, h in sorted(samples):
+                acc = 0
+                for le, n in zip(self.BUCKETS + ("+Inf",), h[:-1]):
+                    acc += n
+                    lines.append(f"{name}_bucket{self._labels(labels, [('le', le)])} {acc}")
+                lines.append(f"{name}_sum{self._labels(labels)} {h[-1]}")
+                lines.append(f"{name}_count{self._labels(labels)} {acc}")
+        for name, samples in sorted(gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in sorted(samples):
+                lines.append(f"{name}{self._labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def db_timed(name: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            t = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            except sqlite3.OperationalError:
+                metrics.inc("db_errors_total", query=name)
+                raise
+            finally:
+                metrics.observe("db_query_seconds", time.perf_counter() - t, query=name)
+        return wrapper
+    return deco
+
+def _timed_api_request(method, url, **kwargs):
+    api = url.rsplit("/", 1)[-1]
+    t = time.perf_counter()
+    try:
+        resp = apihelper._get_req_session().request(method, url, **kwargs)
+    except Exception:
+        metrics.inc("telegram_api_errors_total", method=api, code="network")
+        raise
+    finally:
+        metrics.observe("telegram_api_seconds", time.perf_counter() - t, method=api)
+    if resp.status_code != 200:
+        metrics.inc("telegram_api_errors_total", method=api, code=str(resp.status_code))
+    return resp
+
+apihelper.CUSTOM_REQUEST_SENDER = _timed_api_request
+
+# SQLite: har bir oqim (telebot worker, APScheduler executor) o'z ulanishini
+# bir marta ochadi va qayta ishlatadi. WAL rejimida o'quvchilar yozuvchini
+# to'smaydi, sqlite3 esa tayyorlangan so'rovlarni ulanish ichida keshlaydi.
+DB_PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-8000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+_db_local = threading.local()
+_db_pool = {}
+_db_pool_lock = threading.Lock()
+
+def _db_open():
+    conn = sqlite3.connect(
+        DB_PATH,
+        timeout=5,
+        isolation_level=None,
+        check_same_thread=False,
+        cached_statements=256,
+    )
+    for pragma in DB_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
 def db_conn():
-    return sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn = getattr(_db_local, "conn", None)
+    if conn is not None:
+        return conn
+    conn = _db_open()
+    ident = threading.get_ident()
+    with _db_pool_lock:
+        alive = {t.ident for t in threading.enumerate()}
+        for dead in [i for i in _db_pool if i not in alive or i == ident]:
+            _db_pool.pop(dead).close()
+        _db_pool[ident] = conn
+    _db_local.conn = conn
+    return conn
 
-def init_db():
+@contextmanager
+def db_tx():
     conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
+    if conn.in_transaction:
+        yield conn
+        return
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        yield conn
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+
+def db_close_all():
+    with _db_pool_lock:
+        for conn in _db_pool.values():
+            try:
+                conn.close()
+            except Exception:
+                pass
+        _db_pool.clear()
+    _db_local.__dict__.pop("conn", None)
+
+atexit.register(db_close_all)
+
+def _add_columns(conn, table: str, columns):
+    existing = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+    for column in columns:
+        if column.split()[0] not in existing:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column}")
+
+def _migrate_base(conn):
+    # v1: hozirgi sxema. Hammasi IF NOT EXISTS, shuning uchun user_version
+    # bo'lmagan eski bazalar ham shu migratsiya bilan yangilanadi.
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS users (
             chat_id INTEGER PRIMARY KEY,
@@ -73,7 +399,7 @@ def init_db():
         )
         """
     )
-    cur.execute(
+    conn.execute(
         """
         CREATE TABLE IF NOT EXISTS progress (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -84,103 +410,949 @@ def init_db():
         )
         """
     )
-    conn.commit()
-    try:
-        cur.execute("ALTER TABLE users ADD COLUMN consult_mode INTEGER DEFAULT 0")
-        conn.commit()
-    except Exception:
-        pass
-    conn.close()
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            admin_id INTEGER,
+            kind TEXT,
+            text TEXT,
+            file_id TEXT,
+            priority INTEGER DEFAULT 1,
+            status TEXT DEFAULT 'pending',
+            total INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            report_message_id INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_targets (
+            broadcast_id INTEGER,
+            chat_id INTEGER,
+            status INTEGER DEFAULT 0,
+            PRIMARY KEY (broadcast_id, chat_id)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_chat_date ON progress (chat_id, date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_date ON progress (date)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS chat_state (
+            chat_id INTEGER PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            updated_at REAL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS leases (
+            name TEXT PRIMARY KEY,
+            owner TEXT,
+            expires_at REAL
+        )
+        """
+    )
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS seen_updates (
+            key TEXT PRIMARY KEY,
+            seen_at REAL
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_seen_updates_at ON seen_updates (seen_at)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS reminders (
+            id INTEGER PRIMARY KEY,
+            chat_id INTEGER NOT NULL,
+            date TEXT,
+            label TEXT,
+            status INTEGER DEFAULT 0,
+            snoozes INTEGER DEFAULT 0,
+            snooze_until REAL,
+            created_at REAL
+        )
+        """
+    )
+    conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_reminders_chat_day ON reminders (chat_id, date, label)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_reminders_date ON reminders (date)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_product ON users (product, chat_id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_issue ON users (issue, chat_id)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS progress_daily (
+            chat_id INTEGER,
+            date TEXT,
+            label TEXT,
+            product TEXT,
+            done INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (chat_id, date, label)
+        ) WITHOUT ROWID
+        """
+    )
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_progress_daily_date ON progress_daily (date)")
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS progress_totals (
+            chat_id INTEGER PRIMARY KEY,
+            done INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0
+        )
+        """
+    )
+    if not conn.execute("SELECT 1 FROM progress_totals LIMIT 1").fetchone():
+        rebuild_progress_rollups(conn)
+    _add_columns(conn, "users", (
+        "consult_mode INTEGER DEFAULT 0",
+        "tz_offset INTEGER",
+        "reminder_times TEXT",
+        "next_fire_at REAL",
+        "next_slot INTEGER",
+    ))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_users_next_fire ON users (next_fire_at)")
+    schedule_unscheduled_users()
 
-def get_user(chat_id: int):
+def _migrate_global_rollup(conn):
+    # v2: admin statistikasi uchun chat_id siz kunlik yig'indi
+    conn.execute(
+        """
+        CREATE TABLE IF NOT EXISTS progress_global (
+            date TEXT,
+            label TEXT,
+            product TEXT,
+            done INTEGER DEFAULT 0,
+            total INTEGER DEFAULT 0,
+            PRIMARY KEY (date, label, product)
+        ) WITHOUT ROWID
+        """
+    )
+    rebuild_global_rollup(conn)
+
+def _migrate_counters(conn):
+    # v3: admin statistikasi uchun foydalanuvchilar soni (COUNT(*) o'rniga)
+    conn.execute("CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER DEFAULT 0) WITHOUT ROWID")
+    conn.execute("INSERT OR REPLACE INTO counters (name, value) SELECT 'users', COUNT(*) FROM users")
+
+# Yangi migratsiya faqat oxiriga qo'shiladi; indeks + 1 = PRAGMA user_version
+MIGRATIONS = [_migrate_base, _migrate_global_rollup, _migrate_counters]
+
+def init_db():
+    """Sxemani PRAGMA user_version bo'yicha bir marta yangilaydi.
+
+    Baza oxirgi versiyada bo'lsa bitta PRAGMA o'qishdan iborat.
+    """
     conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= len(MIGRATIONS):
+        return
+    if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+        # Bir martalik: o'chirilgan sahifalarni compact_progress qaytara oladi
+        logging.info("enabling incremental auto_vacuum (one-time VACUUM)")
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    for version, migrate in enumerate(MIGRATIONS, 1):
+        with db_tx() as tx:
+            # Boshqa jarayon allaqachon bajargan bo'lishi mumkin
+            if tx.execute("PRAGMA user_version").fetchone()[0] >= version:
+                continue
+            migrate(tx)
+            tx.execute(f"PRAGMA user_version = {version}")
+        logging.info("schema migrated to v%s", version)
 
-def add_user(chat_id: int, name: str, age=None, weight=None, height=None, product=None, issue=None):
-    now = datetime.utcnow().isoformat()
+# users qatoridagi keyinroq qo'shilgan ustunlar (SELECT * tartibida)
+U_CONSULT, U_TZ, U_TIMES, U_NEXT_FIRE, U_NEXT_SLOT = 10, 11, 12, 13, 14
+
+# progress_totals dagi chat_id = 0 qatori barcha foydalanuvchilar yig'indisi
+TOTALS_ALL = 0
+
+def _prune(table: str, key: str, date_before: str) -> int:
+    # Kichik tranzaksiyalar: handlerlar yozuvchi qulfini uzoq kutmaydi
+    removed = 0
+    while True:
+        with db_tx() as conn:
+            n = conn.execute(
+                f"DELETE FROM {table} WHERE ({key}) IN (SELECT {key} FROM {table} WHERE date < ? LIMIT ?)",
+                (date_before, PRUNE_BATCH),
+            ).rowcount
+        removed += n
+        if n < PRUNE_BATCH:
+            return removed
+        time.sleep(0.05)
+
+def drop_broadcast_targets(bid: int) -> int:
+    # Tugagan anonsning qabul qiluvchilari kerak emas: hisobot broadcasts dagi sanoqlardan
+    removed = 0
+    while True:
+        with db_tx() as conn:
+            n = conn.execute(
+                """
+                DELETE FROM broadcast_targets WHERE broadcast_id = ? AND chat_id IN
+                    (SELECT chat_id FROM broadcast_targets WHERE broadcast_id = ? LIMIT ?)
+                """,
+                (bid, bid, PRUNE_BATCH),
+            ).rowcount
+        removed += n
+        if n < PRUNE_BATCH:
+            return removed
+        time.sleep(0.05)
+
+def prune_broadcasts(finished_before: str) -> int:
+    with db_tx() as conn:
+        ids = [r[0] for r in conn.execute(
+            "SELECT id FROM broadcasts WHERE status = 'done' AND finished_at < ?", (finished_before,)
+        )]
+        conn.execute("DELETE FROM broadcasts WHERE status = 'done' AND finished_at < ?", (finished_before,))
+    # _finish dan oldin jarayon to'xtagan bo'lsa, qolgan qabul qiluvchilar ham tozalanadi
+    for bid in ids:
+        drop_broadcast_targets(bid)
+    return len(ids)
+
+def compact_progress():
+    """Eski xom progress, kunlik yig'indilar va anonslarni o'chiradi, bo'sh sahifalarni qaytaradi.
+
+    progress_daily va progress_totals log_progress da yangilanib boradi, shuning
+    uchun xom qatorlarni o'chirish statistikani o'zgartirmaydi.
+    """
+    today = datetime.utcnow().date()
+    raw = _prune("progress", "rowid", (today - timedelta(days=PROGRESS_RETENTION_DAYS)).isoformat())
+    daily = _prune("progress_daily", "chat_id, date, label", (today - timedelta(days=PROGRESS_DAILY_RETENTION_DAYS)).isoformat())
+    _prune("progress_global", "date, label, product", (today - timedelta(days=PROGRESS_DAILY_RETENTION_DAYS)).isoformat())
+    _prune("reminders", "id", (today - timedelta(days=PROGRESS_RETENTION_DAYS)).isoformat())
+    broadcasts = prune_broadcasts((today - timedelta(days=PROGRESS_RETENTION_DAYS)).isoformat())
+    metrics.inc("progress_pruned_total", broadcasts, table="broadcasts")
+    metrics.inc("progress_pruned_total", raw, table="progress")
+    metrics.inc("progress_pruned_total", daily, table="progress_daily")
     conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
+    free = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    freed = 0
+    while free:
+        # executescript pragmani oxirigacha bajaradi (execute faqat bitta sahifa)
+        conn.executescript(f"PRAGMA incremental_vacuum({VACUUM_PAGES});")
+        left = conn.execute("PRAGMA freelist_count").fetchone()[0]
+        if left >= free:
+            break
+        freed += free - left
+        free = left
+        time.sleep(0.05)
+    logging.info("compact_progress: progress=%s progress_daily=%s pages~%s", raw, daily, freed)
+
+def rebuild_progress_rollups(conn):
+    conn.execute("DELETE FROM progress_daily")
+    conn.execute("DELETE FROM progress_totals")
+    conn.execute(
+        """
+        INSERT INTO progress_daily (chat_id, date, label, product, done, total)
+        SELECT p.chat_id, p.date, p.reminder_time, COALESCE(u.product, '-'), SUM(p.done), COUNT(*)
+        FROM progress p LEFT JOIN users u ON u.chat_id = p.chat_id
+        GROUP BY p.chat_id, p.date, p.reminder_time
         """
-        INSERT OR REPLACE INTO users (chat_id, name, age, weight, height, product, issue, start_date, week, created_at)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (chat_id, name, age, weight, height, product, issue, now, 1, now),
     )
-    conn.commit()
-    conn.close()
+    conn.execute(
+        """
+        INSERT INTO progress_totals (chat_id, done, total)
+        SELECT chat_id, SUM(done), SUM(total) FROM progress_daily GROUP BY chat_id
+        """
+    )
+    conn.execute(
+        "INSERT INTO progress_totals (chat_id, done, total) SELECT ?, COALESCE(SUM(done), 0), COALESCE(SUM(total), 0) FROM progress_daily",
+        (TOTALS_ALL,),
+    )
 
-def update_user_field(chat_id: int, field: str, value):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(f"UPDATE users SET {field} = ? WHERE chat_id = ?", (value, chat_id))
-    conn.commit()
-    conn.close()
+def rebuild_global_rollup(conn):
+    conn.execute("DELETE FROM progress_global")
+    conn.execute(
+        """
+        INSERT INTO progress_global (date, label, product, done, total)
+        SELECT date, label, product, SUM(done), SUM(total) FROM progress_daily GROUP BY date, label, product
+        """
+    )
 
-def log_progress(chat_id: int, reminder_time: str, done: bool):
-    d = datetime.utcnow().date().isoformat()
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO progress (chat_id, date, reminder_time, done) VALUES (?, ?, ?, ?)",
-        (chat_id, d, reminder_time, 1 if done else 0),
+class LRUCache:
+    """Hajmi va yashash muddati cheklangan, oqimlar uchun xavfsiz kesh."""
+
+    MISSING = object()
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self._gen = 0
+        self.hits = self.misses = self.evictions = 0
+
+    def generation(self) -> int:
+        return self._gen
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[1] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return item[0]
+            if item is not None:
+                del self._data[key]
+            self.misses += 1
+            return self.MISSING
+
+    def put(self, key, value, gen=None):
+        with self._lock:
+            # O'qish paytida yozuv bo'lgan bo'lsa eskirgan qiymat saqlanmaydi
+            if gen is not None and gen != self._gen:
+                return
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._gen += 1
+            self._data.pop(key, None)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_ratio": self.hits / lookups if lookups else 0.0,
+            }
+
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+@db_timed("get_user")
+def _load_user(chat_id: int):
+    return db_conn().execute("SELECT * FROM users WHERE chat_id = ?", (chat_id,)).fetchone()
+
+def _refresh_user(chat_id: int):
+    user_cache.invalidate(chat_id)
+    user_cache.put(chat_id, _load_user(chat_id))
+
+def get_user(chat_id: int):
+    row = user_cache.get(chat_id)
+    if row is not LRUCache.MISSING:
+        return row
+    gen = user_cache.generation()
+    row = _load_user(chat_id)
+    user_cache.put(chat_id, row, gen)
+    return row
+
+def parse_times(value) -> list:
+    """"08:00,13:00,19:00" -> kun boshidan daqiqalar; bo'sh bo'lsa REMINDER_SLOTS."""
+    if not value:
+        return [h * 60 for h, _ in REMINDER_SLOTS]
+    return [int(t[:2]) * 60 + int(t[3:5]) for t in value.split(",")]
+
+def format_times(minutes) -> str:
+    return ",".join(f"{m // 60:02d}:{m % 60:02d}" for m in minutes)
+
+def next_fire(tz_offset, times, after: float):
+    """after dan keyingi eng yaqin eslatma: (UTC timestamp, REMINDER_SLOTS indeksi)."""
+    tz = timezone(timedelta(minutes=DEFAULT_TZ_MINUTES if tz_offset is None else tz_offset))
+    midnight = datetime.fromtimestamp(after, tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    for day in (0, 1):
+        base = (midnight + timedelta(days=day)).timestamp()
+        due = [(base + m * 60, i) for i, m in enumerate(parse_times(times)) if base + m * 60 > after]
+        if due:
+            return min(due)
+
+def local_date(tz_offset, ts: float) -> str:
+    tz = timezone(timedelta(minutes=DEFAULT_TZ_MINUTES if tz_offset is None else tz_offset))
+    return datetime.fromtimestamp(ts, tz).date().isoformat()
+
+def schedule_unscheduled_users():
+    # Yangi ustunlar qo'shilganda mavjud foydalanuvchilarga keyingi vaqt beriladi
+    now = time.time()
+    while True:
+        rows = db_conn().execute(
+            "SELECT chat_id, tz_offset, reminder_times FROM users WHERE next_fire_at IS NULL LIMIT ?", (SLOT_CHUNK,)
+        ).fetchall()
+        if not rows:
+            return
+        with db_tx() as conn:
+            conn.executemany(
+                "UPDATE users SET next_fire_at = ?, next_slot = ? WHERE chat_id = ?",
+                [(*next_fire(tz, times, now), cid) for cid, tz, times in rows],
+            )
+
+@db_timed("set_schedule")
+def set_schedule(chat_id: int, tz_offset, times):
+    at, slot = next_fire(tz_offset, times, time.time())
+    db_conn().execute(
+        "UPDATE users SET tz_offset = ?, reminder_times = ?, next_fire_at = ?, next_slot = ? WHERE chat_id = ?",
+        (tz_offset, times, at, slot, chat_id),
     )
-    conn.commit()
-    conn.close()
+    _refresh_user(chat_id)
 
-def list_user_ids():
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT chat_id FROM users")
-    rows = cur.fetchall()
-    conn.close()
-    return [r[0] for r in rows]
+def _count_new_user(conn, chat_id: int):
+    # users ga yozishdan oldin, o'sha tranzaksiya ichida chaqiriladi
+    if conn.execute("SELECT 1 FROM users WHERE chat_id = ?", (chat_id,)).fetchone() is None:
+        conn.execute("UPDATE counters SET value = value + 1 WHERE name = 'users'")
+
+@db_timed("add_user")
+def add_user(chat_id: int, name: str, age=None, weight=None, height=None, product=None, issue=None):
+    now = datetime.utcnow().isoformat()
+    at, slot = next_fire(None, None, time.time())
+    with db_tx() as conn:
+        _count_new_user(conn, chat_id)
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO users (chat_id, name, age, weight, height, product, issue, start_date, week, created_at, next_fire_at, next_slot)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (chat_id, name, age, weight, height, product, issue, now, 1, now, at, slot),
+        )
+    _refresh_user(chat_id)
+
+@db_timed("update_user_field")
+def update_user_field(chat_id: int, field: str, value):
+    db_conn().execute(f"UPDATE users SET {field} = ? WHERE chat_id = ?", (value, chat_id))
+    _refresh_user(chat_id)
+
+@db_timed("log_progress")
+def log_progress(chat_id: int, reminder_time: str, done: bool, day: str = None):
+    d = day or datetime.utcnow().date().isoformat()
+    v = 1 if done else 0
+    with db_tx() as conn:
+        conn.execute(
+            "INSERT INTO progress (chat_id, date, reminder_time, done) VALUES (?, ?, ?, ?)",
+            (chat_id, d, reminder_time, v),
+        )
+        conn.execute(
+            """
+            INSERT INTO progress_daily (chat_id, date, label, product, done, total)
+            VALUES (?, ?, ?, COALESCE((SELECT product FROM users WHERE chat_id = ?), '-'), ?, 1)
+            ON CONFLICT (chat_id, date, label) DO UPDATE SET done = done + excluded.done, total = total + 1
+            """,
+            (chat_id, d, reminder_time, chat_id, v),
+        )
+        conn.execute(
+            """
+            INSERT INTO progress_global (date, label, product, done, total)
+            VALUES (?, ?, COALESCE((SELECT product FROM users WHERE chat_id = ?), '-'), ?, 1)
+            ON CONFLICT (date, label, product) DO UPDATE SET done = done + excluded.done, total = total + 1
+            """,
+            (d, reminder_time, chat_id, v),
+        )
+        conn.executemany(
+            """
+            INSERT INTO progress_totals (chat_id, done, total) VALUES (?, ?, 1)
+            ON CONFLICT (chat_id) DO UPDATE SET done = done + excluded.done, total = total + 1
+            """,
+            ((chat_id, v), (TOTALS_ALL, v)),
+        )
+
+class RateLimiter:
+    """Umumiy tezlik va har bir chat uchun minimal oraliqni ushlab turadi."""
+
+    def __init__(self, rate: float, chat_interval: float):
+        self.interval = 1.0 / rate
+        self.chat_interval = chat_interval
+        self._lock = threading.Lock()
+        self._next = 0.0
+        self._chat_next = {}
+
+    def acquire(self, chat_id: int):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next)
+            self._next = slot + self.interval
+            at = max(slot, self._chat_next.get(chat_id, 0.0))
+            self._chat_next[chat_id] = at + self.chat_interval
+            if len(self._chat_next) > 50000:
+                self._chat_next = {k: v for k, v in self._chat_next.items() if v > now}
+        delay = at - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+    def pause(self, seconds: float):
+        with self._lock:
+            self._next = max(self._next, time.monotonic() + seconds)
+
+send_limiter = RateLimiter(SEND_RATE, SEND_CHAT_INTERVAL)
+sender_pool = ThreadPoolExecutor(max_workers=SENDER_THREADS, thread_name_prefix="sender")
+
+def send_with_retry(method, chat_id: int, *args, attempts: int = 5, **kwargs) -> bool:
+    for attempt in range(attempts):
+        send_limiter.acquire(chat_id)
+        try:
+            method(chat_id, *args, **kwargs)
+            return True
+        except ApiTelegramException as e:
+            if e.error_code == 429:
+                retry_after = ((e.result_json or {}).get("parameters") or {}).get("retry_after", 1)
+                logging.warning("flood wait %ss (chat %s)", retry_after, chat_id)
+                send_limiter.pause(retry_after)
+                continue
+            if e.error_code in (400, 403):
+                return False
+            logging.warning("send to %s failed: %s", chat_id, e)
+        except Exception as e:
+            logging.warning("send to %s failed: %s", chat_id, e)
+        time.sleep(min(2 ** attempt, 30))
+    return False
+
+def deliver(kind: str, chat_id: int, text: str, file_id=None) -> bool:
+    if kind == "photo":
+        return send_with_retry(bot.send_photo, chat_id, file_id, caption=text)
+    if kind == "video":
+        return send_with_retry(bot.send_video, chat_id, file_id, caption=text)
+    return send_with_retry(bot.send_message, chat_id, text)
+
+def _decode_user_filter(fcode: str):
+    """Callback_data dagi filtr kodi: "" | p<i> | i<i> | q<matn>."""
+    if not fcode:
+        return "", []
+    kind, val = fcode[0], fcode[1:]
+    if kind == "p" and val.isdigit() and int(val) < len(PRODUCTS):
+        return " AND product = ?", [PRODUCTS[int(val)]]
+    if kind == "i" and val.isdigit() and int(val) < len(ISSUES):
+        return " AND issue = ?", [ISSUES[int(val)]]
+    if kind == "q" and val:
+        pattern = val.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+        return " AND name LIKE ? ESCAPE '\\'", [f"%{pattern}%"]
+    return "", []
+
+@db_timed("list_users_page")
+def list_users_page(cursor=None, backward: bool = False, fcode: str = "", limit: int = ADMIN_PAGE_SIZE):
+    where, params = _decode_user_filter(fcode)
+    if cursor is not None:
+        where += " AND chat_id < ?" if backward else " AND chat_id > ?"
+        params.append(cursor)
+    order = "DESC" if backward else "ASC"
+    rows = db_conn().execute(
+        f"SELECT chat_id, name, product, issue FROM users WHERE 1 = 1{where} ORDER BY chat_id {order} LIMIT ?",
+        params + [limit + 1],
+    ).fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if backward:
+        rows.reverse()
+    return rows, more
 
+EXPORT_TABLES = {
+    "users": (
+        "u", "chat_id",
+        ["chat_id", "name", "age", "weight", "height", "product", "issue", "start_date", "week", "created_at", "consult_mode",
+         "tz_offset", "reminder_times"],
+        "users u", "u.created_at",
+    ),
+    "progress": (
+        "p", "id",
+        ["id", "chat_id", "date", "reminder_time", "done"],
+        "progress p LEFT JOIN users u ON u.chat_id = p.chat_id", "p.date",
+    ),
+}
+
+def iter_export_rows(table: str, date_from=None, date_to=None, product=None, issue=None):
+    """Jadvalni EXPORT_CHUNK bo'laklarida, kalit bo'yicha sahifalab o'qiydi.
+
+    Har bir bo'lak alohida qisqa so'rov: uzun o'qish tranzaksiyasi ochilmaydi
+    va log_progress yozuvlari kutib qolmaydi.
+    """
+    alias, key, columns, source, date_col = EXPORT_TABLES[table]
+    key_col = f"{alias}.{key}"
+    where, params = "", []
+    if date_from:
+        where += f" AND {date_col} >= ?"
+        params.append(date_from)
+    if date_to:
+        where += f" AND {date_col} < ?"
+        params.append((datetime.fromisoformat(date_to) + timedelta(days=1)).date().isoformat())
+    if product:
+        where += " AND u.product = ?"
+        params.append(product)
+    if issue:
+        where += " AND u.issue = ?"
+        params.append(issue)
+    select = ", ".join(f"{alias}.{c}" for c in columns)
+    sql = f"SELECT {select} FROM {source} WHERE {key_col} > ?{where} ORDER BY {key_col} LIMIT {EXPORT_CHUNK}"
+    after = -(2 ** 63)
+    while True:
+        t = time.perf_counter()
+        rows = db_conn().execute(sql, [after] + params).fetchall()
+        metrics.observe("db_query_seconds", time.perf_counter() - t, query="export")
+        if not rows:
+            return
+        yield columns, rows
+        after = rows[-1][columns.index(key)]
+
+def write_export(fileobj, table: str, fmt: str, compress: bool, **filters) -> int:
+    raw = gzip.GzipFile(fileobj=fileobj, mode="wb") if compress else fileobj
+    out = io.TextIOWrapper(raw, encoding="utf-8", newline="")
+    writer = csv.writer(out) if fmt == "csv" else None
+    count = 0
+    header = False
+    for columns, rows in iter_export_rows(table, **filters):
+        if writer is not None:
+            if not header:
+                writer.writerow(columns)
+                header = True
+            writer.writerows(rows)
+        else:
+            out.writelines(json.dumps(dict(zip(columns, r)), ensure_ascii=False) + "\n" for r in rows)
+        count += len(rows)
+    if writer is not None and not header:
+        writer.writerow(EXPORT_TABLES[table][2])
+    out.flush()
+    out.detach()
+    if compress:
+        raw.close()
+    return count
+
+@db_timed("create_broadcast")
+def create_broadcast(admin_id, kind: str, text: str, file_id=None, targets=None, priority: int = 1):
+    now = datetime.utcnow().isoformat()
+    with db_tx() as conn:
+        bid = conn.execute(
+            "INSERT INTO broadcasts (admin_id, kind, text, file_id, priority, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (admin_id, kind, text, file_id, priority, now),
+        ).lastrowid
+        if targets is None:
+            conn.execute("INSERT INTO broadcast_targets (broadcast_id, chat_id) SELECT ?, chat_id FROM users", (bid,))
+        else:
+            conn.executemany(
+                "INSERT OR IGNORE INTO broadcast_targets (broadcast_id, chat_id) VALUES (?, ?)",
+                [(bid, cid) for cid in targets],
+            )
+        total = conn.execute("SELECT COUNT(*) FROM broadcast_targets WHERE broadcast_id = ?", (bid,)).fetchone()[0]
+        conn.execute("UPDATE broadcasts SET total = ? WHERE id = ?", (total, bid))
+    return bid, total
+
+def set_broadcast_report(bid: int, message_id: int):
+    db_conn().execute("UPDATE broadcasts SET report_message_id = ? WHERE id = ?", (message_id, bid))
+
+class Broadcaster:
+    """Navbatdagi anonslarni bo'laklab, sender_pool orqali yuboradi.
+
+    Holat bazada saqlanadi, shuning uchun qayta ishga tushganda yuborilmagan
+    qabul qiluvchilardan davom etadi.
+    """
+
+    def __init__(self):
+        self._wake = threading.Event()
+        self._thread = None
+        # Faqat lider jarayonda True (LeaderElector)
+        self.active = False
+        self._cursor = {}
+        self._started = {}
+        self._reported = {}
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="broadcaster", daemon=True)
+            self._thread.start()
+
+    def kick(self):
+        self._wake.set()
+
+    def _run(self):
+        while True:
+            try:
+                while self.active and self._step():
+                    pass
+            except Exception as e:
+                logging.exception("broadcaster error: %s", e)
+            # Boshqa jarayonlar yaratgan anonslar ham tez ko'rinsin
+            self._wake.wait(BROADCAST_POLL_SECONDS if WORKER_PROCESSES > 1 else 30)
+            self._wake.clear()
+
+    def _step(self) -> bool:
+        job = db_conn().execute(
+            "SELECT id, admin_id, kind, text, file_id FROM broadcasts WHERE status IN ('pending', 'running') ORDER BY priority, id LIMIT 1"
+        ).fetchone()
+        if not job:
+            return False
+        bid, admin_id, kind, text, file_id = job
+        if bid not in self._started:
+            self._started[bid] = (time.monotonic(), self._done_count(bid))
+            db_conn().execute("UPDATE broadcasts SET status = 'running' WHERE id = ?", (bid,))
+        rows = db_conn().execute(
+            "SELECT chat_id FROM broadcast_targets WHERE broadcast_id = ? AND chat_id > ? AND status = 0 ORDER BY chat_id LIMIT ?",
+            (bid, self._cursor.get(bid, -(2 ** 63)), BROADCAST_CHUNK),
+        ).fetchall()
+        if not rows:
+            self._finish(bid, admin_id)
+            return True
+        futures = [(cid, sender_pool.submit(deliver, kind, cid, text, file_id)) for (cid,) in rows]
+        results = [(1 if f.result() else 2, bid, cid) for cid, f in futures]
+        sent = sum(1 for r in results if r[0] == 1)
+        with db_tx() as conn:
+            conn.executemany("UPDATE broadcast_targets SET status = ? WHERE broadcast_id = ? AND chat_id = ?", results)
+            conn.execute(
+                "UPDATE broadcasts SET sent = sent + ?, failed = failed + ? WHERE id = ?",
+                (sent, len(results) - sent, bid),
+            )
+        self._cursor[bid] = rows[-1][0]
+        if admin_id and time.monotonic() - self._reported.get(bid, 0.0) >= BROADCAST_REPORT_SECONDS:
+            self._report(bid, admin_id, final=False)
+        return True
+
+    def _done_count(self, bid: int) -> int:
+        row = db_conn().execute("SELECT sent + failed FROM broadcasts WHERE id = ?", (bid,)).fetchone()
+        return row[0] if row else 0
+
+    def _finish(self, bid: int, admin_id):
+        db_conn().execute(
+            "UPDATE broadcasts SET status = 'done', finished_at = ? WHERE id = ?",
+            (datetime.utcnow().isoformat(), bid),
+        )
+        drop_broadcast_targets(bid)
+        if admin_id:
+            self._report(bid, admin_id, final=True)
+        for d in (self._cursor, self._started, self._reported):
+            d.pop(bid, None)
+
+    def _report(self, bid: int, admin_id: int, final: bool):
+        self._reported[bid] = time.monotonic()
+        total, sent, failed, report_id = db_conn().execute(
+            "SELECT total, sent, failed, report_message_id FROM broadcasts WHERE id = ?", (bid,)
+        ).fetchone()
+        started, done_before = self._started.get(bid, (time.monotonic(), 0))
+        elapsed = max(time.monotonic() - started, 0.001)
+        rate = (sent + failed - done_before) / elapsed
+        head = "✅ Anons yakunlandi" if final else "📣 Anons yuborilmoqda"
+        text = f"{head}\nYuborildi: {sent}/{total}\nXato: {failed}\nTezlik: {rate:.1f} ta/s"
+        try:
+            if report_id:
+                bot.edit_message_text(text, admin_id, report_id)
+            else:
+                bot.send_message(admin_id, text)
+        except Exception as e:
+            logging.warning("broadcast report failed: %s", e)
+
+broadcaster = Broadcaster()
+
+ADMIN_BUTTONS = ("👥 Foydalanuvchilar", "📈 Statistika", "📣 Anons yuborish")
 admin_kb = types.ReplyKeyboardMarkup(resize_keyboard=True)
-admin_kb.add(types.KeyboardButton("👥 Foydalanuvchilar"), types.KeyboardButton("📈 Statistika"))
-admin_kb.add(types.KeyboardButton("📣 Anons yuborish"))
+admin_kb.add(types.KeyboardButton(ADMIN_BUTTONS[0]), types.KeyboardButton(ADMIN_BUTTONS[1]))
+admin_kb.add(types.KeyboardButton(ADMIN_BUTTONS[2]))
 admin_kb.add(types.KeyboardButton("⬅️ Orqaga"))
 
-admin_modes = {}
-
+@db_timed("set_consult_mode")
 def set_consult_mode(chat_id: int, on: bool):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE users SET consult_mode = ? WHERE chat_id = ?", (1 if on else 0, chat_id))
-    conn.commit()
-    conn.close()
+    db_conn().execute("UPDATE users SET consult_mode = ? WHERE chat_id = ?", (1 if on else 0, chat_id))
+    _refresh_user(chat_id)
 
 def get_consult_mode(chat_id: int) -> int:
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT consult_mode FROM users WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    conn.close()
-    return (row[0] if row else 0) or 0
+    row = get_user(chat_id)
+    return (row[U_CONSULT] if row else 0) or 0
+
+DEFAULT_INTENTS = [
+    {
+        "keywords": ["oshqozon", "hazm", "kislota", "gaz", "qorin"],
+        "reply": "Assalomu alaykum, {name}. Men Nutresolog Sardor Xasanovich. Oshqozon va hazm uchun kunlik ovqatni yengil tuting, ko'p yog'li va achchiq ovqatlardan saqlaning. {product} ni belgilangan vaqtda qabul qiling, suvni yetarli iching.",
+    },
+    {
+        "keywords": ["bo'g'im", "suyak", "og'riq", "artrit"],
+        "reply": "{name}, bo'g'imlar uchun mikroharakatlar va cho'zilish mashqlari tavsiya etaman. Kalsiy va D vitamini boy ovqatlar iste'mol qiling. {product} ni 08:00, 13:00, 19:00 da muntazam iching.",
+    },
+    {
+        "keywords": ["prostata", "siydik", "erkak"],
+        "reply": "{name}, prostata salomatligi uchun yurish va to'yimli oqsil manbalari foydali. Suvni ko'proq iching, kechqurun tuz va yog'ni kamaytiring. {product} qabulini davom ettiring.",
+    },
+    {
+        "keywords": ["detoks", "vazn", "semirish", "parhez"],
+        "reply": "{name}, vazn nazorati uchun shakarni cheklang, tola va oqsilni ko'paytiring, har kuni 8-10 ming qadam yuring. {product} ni jadval bo'yicha iching.",
+    },
+    {
+        "keywords": ["qon bosim", "bosim", "gipertoniya"],
+        "reply": "{name}, qon bosimi uchun tuzni kamaytiring, stressni boshqarishga e'tibor bering, kundalik yurish qiling. {product} ni belgilangan dozada qabul qiling.",
+    },
+    {
+        "keywords": ["shakar", "qand", "diabet"],
+        "reply": "{name}, shakarni barqaror ushlab turish uchun porsiya nazorati va past glikemik indeksli ovqatlar tanlang. {product} ni ovqat oldi suv bilan iching.",
+    },
+]
+FALLBACK_REPLY = "{name}, savolingiz uchun rahmat. Men Nutresolog Sardor Xasanovich. Siz uchun umumiy tavsiya: {meal}. Agar aniq alomat bo'lsa, batafsil yozing."
+
+# O'zbekcha apostrof variantlari (ʻ ’ ‘ ʼ `) bitta ' ga keltiriladi
+_APOSTROPHES = str.maketrans({c: "'" for c in "ʻʼ’‘`´"})
+
+def normalize_text(text: str) -> str:
+    return text.translate(_APOSTROPHES).lower()
+
+# Shablonlarga beriladigan qiymatlar: mavzu javobi va umumiy javob uchun
+INTENT_FIELDS = ("name", "product")
+FALLBACK_FIELDS = ("name", "meal")
+
+def compile_template(template: str, fields):
+    """str.format shablonini bir marta tahlil qilib, tez render funksiyasini qaytaradi.
+
+    Noma'lum maydon, !conv yoki :spec bo'lsa ValueError: xato yuklashda chiqadi, javob paytida emas.
+    """
+    parts = []
+    for literal, field, spec, conv in string.Formatter().parse(template):
+        if field is not None and (field not in fields or spec or conv):
+            text = field + (f"!{conv}" if conv else "") + (f":{spec}" if spec else "")
+            raise ValueError(f"unsupported placeholder {{{text}}} in template, allowed: {', '.join(fields)}")
+        parts.append((literal, field))
+
+    def render(**values) -> str:
+        return "".join(literal + (str(values[field]) if field is not None else "") for literal, field in parts)
+
+    return render
+
+class IntentMatcher:
+    """Aho-Corasick avtomati: matn bir marta o'qiladi, kalit so'zlar soniga bog'liq emas.
+
+    Bir nechta mavzu mos kelsa, ro'yxatda birinchi turgani tanlanadi.
+    """
+
+    def __init__(self, intents):
+        self.replies = [compile_template(i["reply"], INTENT_FIELDS) for i in intents]
+        self._goto = [{}]
+        self._out = [None]
+        for idx, intent in enumerate(intents):
+            for kw in intent["keywords"]:
+                node = 0
+                for ch in normalize_text(kw):
+                    nxt = self._goto[node].get(ch)
+                    if nxt is None:
+                        nxt = len(self._goto)
+                        self._goto[node][ch] = nxt
+                        self._goto.append({})
+                        self._out.append(None)
+                    node = nxt
+                if self._out[node] is None or idx < self._out[node]:
+                    self._out[node] = idx
+        self._fail = [0] * len(self._goto)
+        order = list(self._goto[0].values())
+        for node in order:
+            for ch, nxt in self._goto[node].items():
+                order.append(nxt)
+                f = self._fail[node]
+                while f and ch not in self._goto[f]:
+                    f = self._fail[f]
+                self._fail[nxt] = self._goto[f].get(ch, 0)
+                fo = self._out[self._fail[nxt]]
+                if fo is not None and (self._out[nxt] is None or fo < self._out[nxt]):
+                    self._out[nxt] = fo
+
+    def match(self, text: str):
+        goto, fail, out = self._goto, self._fail, self._out
+        best = None
+        node = 0
+        for ch in normalize_text(text):
+            while node and ch not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(ch, 0)
+            hit = out[node]
+            if hit is not None and (best is None or hit < best):
+                best = hit
+                if best == 0:
+                    break
+        return best
+
+def validate_intents(intents):
+    if not isinstance(intents, list) or not intents:
+        raise ValueError("intents must be a non-empty list")
+    for n, intent in enumerate(intents):
+        keywords = intent.get("keywords") if isinstance(intent, dict) else None
+        if not keywords or not isinstance(keywords, list) or not all(isinstance(k, str) and k.strip() for k in keywords):
+            raise ValueError(f"intent #{n}: 'keywords' must be a non-empty list of strings")
+        if not isinstance(intent.get("reply"), str):
+            raise ValueError(f"intent #{n}: 'reply' must be a string")
+        try:
+            compile_template(intent["reply"], INTENT_FIELDS)
+        except ValueError as e:
+            raise ValueError(f"intent #{n}: {e}") from None
+    return intents
+
+def load_intents():
+    if os.path.exists(INTENTS_PATH):
+        try:
+            with open(INTENTS_PATH, encoding="utf-8") as f:
+                return validate_intents(json.load(f))
+        except Exception as e:
+            logging.error("intents load failed (%s), using defaults: %s", INTENTS_PATH, e)
+    return DEFAULT_INTENTS
+
+intent_matcher = IntentMatcher(load_intents())
+fallback_reply = compile_template(FALLBACK_REPLY, FALLBACK_FIELDS)
+
+# Har bir chat uchun suhbat holati (chekli avtomat) bazada saqlanadi:
+# qayta ishga tushish va bir nechta jarayon orasida yo'qolmaydi.
+state_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+NO_STATE = (None, {})
+
+@db_timed("get_state")
+def _load_state(chat_id: int):
+    row = db_conn().execute("SELECT state, data, updated_at FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchone()
+    if not row or row[2] < time.time() - STATE_TTL:
+        return NO_STATE
+    return row[0], json.loads(row[1] or "{}")
+
+def get_state(chat_id: int):
+    st = state_cache.get(chat_id)
+    if st is not LRUCache.MISSING:
+        return st
+    gen = state_cache.generation()
+    st = _load_state(chat_id)
+    state_cache.put(chat_id, st, gen)
+    return st
+
+@db_timed("set_state")
+def set_state(chat_id: int, state: str, data=None):
+    data = data or {}
+    db_conn().execute(
+        """
+        INSERT INTO chat_state (chat_id, state, data, updated_at) VALUES (?, ?, ?, ?)
+        ON CONFLICT (chat_id) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at
+        """,
+        (chat_id, state, json.dumps(data, ensure_ascii=False), time.time()),
+    )
+    state_cache.invalidate(chat_id)
+    state_cache.put(chat_id, (state, data))
+
+def clear_state(chat_id: int, conn=None):
+    (conn or db_conn()).execute("DELETE FROM chat_state WHERE chat_id = ?", (chat_id,))
+    state_cache.invalidate(chat_id)
+    state_cache.put(chat_id, NO_STATE)
+
+@db_timed("save_profile")
+def save_profile(chat_id: int, data: dict):
+    """Registratsiya formasini bitta tranzaksiyada yozadi va holatni tozalaydi.
+
+    Mavjud qatorning mahsulot, muammo va boshqa ustunlari saqlanib qoladi.
+    """
+    now = datetime.utcnow().isoformat()
+    at, slot = next_fire(None, None, time.time())
+    with db_tx() as conn:
+        _count_new_user(conn, chat_id)
+        conn.execute(
+            """
+            INSERT INTO users (chat_id, name, age, weight, height, start_date, week, created_at, next_fire_at, next_slot)
+            VALUES (?, ?, ?, ?, ?, ?, 1, ?, ?, ?)
+            ON CONFLICT (chat_id) DO UPDATE SET
+                name = excluded.name, age = excluded.age, weight = excluded.weight, height = excluded.height
+            """,
+            (chat_id, data.get("name"), data.get("age"), data.get("weight"), data.get("height"), now, now, at, slot),
+        )
+        clear_state(chat_id, conn)
+    _refresh_user(chat_id)
 
 def ai_reply(text: str, user_row) -> str:
-    t = text.lower()
     name = user_row[1] if user_row else "Do'st"
     issue = user_row[6] if user_row else None
     product = user_row[5] if user_row else "Painnoll"
-    if any(k in t for k in ["oshqozon", "hazm", "kislota", "gaz", "qorin"]):
-        return f"Assalomu alaykum, {name}. Men Nutresolog Sardor Xasanovich. Oshqozon va hazm uchun kunlik ovqatni yengil tuting, ko'p yog'li va achchiq ovqatlardan saqlaning. {product} ni belgilangan vaqtda qabul qiling, suvni yetarli iching."
-    if any(k in t for k in ["bo'g'im", "suyak", "og'riq", "artrit"]):
-        return f"{name}, bo'g'imlar uchun mikroharakatlar va cho'zilish mashqlari tavsiya etaman. Kalsiy va D vitamini boy ovqatlar iste'mol qiling. {product} ni 08:00, 13:00, 19:00 da muntazam iching."
-    if any(k in t for k in ["prostata", "siydik", "erkak"]):
-        return f"{name}, prostata salomatligi uchun yurish va to'yimli oqsil manbalari foydali. Suvni ko'proq iching, kechqurun tuz va yog'ni kamaytiring. {product} qabulini davom ettiring."
-    if any(k in t for k in ["detoks", "vazn", "semirish", "parhez"]):
-        return f"{name}, vazn nazorati uchun shakarni cheklang, tola va oqsilni ko'paytiring, har kuni 8-10 ming qadam yuring. {product} ni jadval bo'yicha iching."
-    if any(k in t for k in ["qon bosim", "bosim", "gipertoniya"]):
-        return f"{name}, qon bosimi uchun tuzni kamaytiring, stressni boshqarishga e'tibor bering, kundalik yurish qiling. {product} ni belgilangan dozada qabul qiling."
-    if any(k in t for k in ["shakar", "qand", "diabet"]):
-        return f"{name}, shakarni barqaror ushlab turish uchun porsiya nazorati va past glikemik indeksli ovqatlar tanlang. {product} ni ovqat oldi suv bilan iching."
-    s = simple_meal_suggestion(issue)
-    return f"{name}, savolingiz uchun rahmat. Men Nutresolog Sardor Xasanovich. Siz uchun umumiy tavsiya: {s}. Agar aniq alomat bo'lsa, batafsil yozing."
+    idx = intent_matcher.match(text)
+    if idx is not None:
+        return intent_matcher.replies[idx](name=name, product=product)
+    return fallback_reply(name=name, meal=simple_meal_suggestion(issue))
 
 def simple_meal_suggestion(issue: str):
     if issue and "Oshqozon" in issue:
@@ -193,130 +1365,435 @@ def simple_meal_suggestion(issue: str):
         return "Kalsiyga boy ovqatlar, yog'siz sut mahsulotlari, yashil bargli sabzavotlar."
     return "Muvozanatli ovqatlaning: oqsil, tolalar va suv."
 
-def _adjust_hour(h: int):
-    return (h + TIMEZONE_OFFSET) % 24
+DAILY_HEAD = compile_template("🌿 Assalomu alaykum, {name}!\n\n", ("name",))
+DAILY_BODY = compile_template(
+    "{label} tavsiya:\n"
+    "• Mahsulotingiz: {product}\n"
+    "• Muvaffaqiyat uchun doz: {dose} kapsula (har doim ko'rsatilgan vaqtda)\n\n"
+    "🍽 Bugungi ovqatlanish tavsiyasi: {meal}\n\n"
+    "👇 Amalni belgilang yoki keyinroq eslatishni so'rang.",
+    ("label", "product", "dose", "meal"),
+)
+
+@functools.lru_cache(maxsize=256)
+def _daily_body(label: str, product, dose: int, issue) -> str:
+    # Ism bo'lmagan qismi bir necha kombinatsiyadan iborat (vaqt x mahsulot x doz x muammo)
+    return DAILY_BODY(label=label, product=product, dose=dose, meal=simple_meal_suggestion(issue))
+
+def render_daily_message(user, label: str) -> str:
+    week = user[8] if user[8] is not None else 1
+    dose = 1 if week == 1 else 2
+    return DAILY_HEAD(name=user[1] or "Do'st") + _daily_body(label, user[5], dose, user[6])
+
+def daily_payload(user, label: str, reminder_id: int) -> dict:
+    # sendMessage so'rov tanasi to'g'ridan-to'g'ri: markup JSON tayyor
+    return {
+        "chat_id": user[0],
+        "text": render_daily_message(user, label),
+        "parse_mode": bot.parse_mode,
+        "reply_markup": daily_markup(reminder_id),
+    }
+
+REMINDER_SENT, REMINDER_DONE, REMINDER_SNOOZED = 0, 1, 2
+
+@db_timed("open_reminders")
+def open_reminders(chat_ids, label: str, day: str = None) -> dict:
+    """(chat, kun, vaqt) uchun eslatma yozuvini ochadi yoki mavjudini qaytaradi: {chat_id: id}."""
+    day = day or datetime.utcnow().date().isoformat()
+    now = time.time()
+    marks = ",".join("?" * len(chat_ids))
+    with db_tx() as conn:
+        conn.executemany(
+            "INSERT OR IGNORE INTO reminders (chat_id, date, label, created_at) VALUES (?, ?, ?, ?)",
+            [(cid, day, label, now) for cid in chat_ids],
+        )
+        rows = conn.execute(
+            f"SELECT chat_id, id FROM reminders WHERE chat_id IN ({marks}) AND date = ? AND label = ?",
+            (*chat_ids, day, label),
+        ).fetchall()
+    return dict(rows)
+
+@db_timed("get_reminder")
+def get_reminder(reminder_id: int, chat_id: int):
+    return db_conn().execute(
+        "SELECT id, date, label, status, snoozes, snooze_until FROM reminders WHERE id = ? AND chat_id = ?",
+        (reminder_id, chat_id),
+    ).fetchone()
 
-def send_daily_message(chat_id: int, label: str):
+def post_message(chat_id: int, payload: dict):
+    # bot.send_message dan farqli: javob Message obyektiga aylantirilmaydi
+    return apihelper._make_request(bot.token, "sendMessage", params=payload, method="post")
+
+def send_snoozed_reminder(chat_id: int, reminder_id: int):
     try:
+        row = get_reminder(reminder_id, chat_id)
+        if not row or row[3] == REMINDER_DONE:
+            return
         user = get_user(chat_id)
         if not user:
             return
-        name = user[1] or "Do'st"
-        week = user[8] if user[8] is not None else 1
-        dose = 1 if week == 1 else 2
-        issue = user[6]
-        text = f"🌿 Assalomu alaykum, {name}!\n\n"
-        text += f"{label} tavsiya:\n"
-        text += f"• Mahsulotingiz: {user[5]}\n"
-        text += f"• Muvaffaqiyat uchun doz: {dose} kapsula (har doim ko'rsatilgan vaqtda)\n\n"
-        text += "🍽 Bugungi ovqatlanish tavsiyasi: {0}\n\n".format(simple_meal_suggestion(issue))
-        text += "👇 Amalni belgilang yoki keyinroq eslatishni so'rang."
-        bot.send_message(chat_id, text, reply_markup=daily_inline)
+        post_message(chat_id, daily_payload(user, row[2], reminder_id))
     except Exception as e:
-        logging.exception("send_daily_message error: %s", e)
+        logging.exception("send_snoozed_reminder error: %s", e)
 
-def schedule_user_jobs(chat_id: int):
-    jobs = [(8, "Ertalab"), (13, "Tushlik"), (19, "Kechqurun")]
-    for h, label in jobs:
-        adj = _adjust_hour(h)
-        job_id = f"{chat_id}-{h}"
-        try:
-            existing = scheduler.get_job(job_id)
-            if existing:
-                scheduler.remove_job(job_id)
-        except Exception:
-            pass
-        scheduler.add_job(send_daily_message, "cron", hour=adj, minute=0, second=0, args=[chat_id, label], id=job_id, replace_existing=True)
+def send_due_reminders():
+    """Muddati kelgan eslatmalarni yuboradi va har bir foydalanuvchining keyingi vaqtini belgilaydi.
+
+    Navbat users.next_fire_at indeksi: har tick faqat vaqti kelgan qatorlarni
+    bo'laklab o'qiydi. SLOT_MISFIRE_GRACE dan ko'p kechikkanlari yuborilmaydi,
+    tick SLOT_WINDOW_SECONDS dan oshsa qolganlari keyingi tickga qoladi.
+    """
+    deadline = time.monotonic() + SLOT_WINDOW_SECONDS
+    sent = failed = skipped = 0
+    pending = []
+    while True:
+        if time.monotonic() >= deadline:
+            logging.warning("reminders: tick window exceeded, rest left for the next tick")
+            break
+        now = time.time()
+        rows = db_conn().execute(
+            "SELECT * FROM users WHERE next_fire_at <= ? ORDER BY next_fire_at LIMIT ?", (now, SLOT_CHUNK)
+        ).fetchall()
+        if not rows:
+            break
+        groups = {}
+        # Keyingi vaqt yuborishdan oldin yoziladi: qayta ishga tushsa ikki marta ketmaydi.
+        # next_fire_at o'zgarmagan qatorgina olinadi - boshqa lider olgan bo'lsa, o'tkaziladi.
+        with db_tx() as conn:
+            for u in rows:
+                claimed = conn.execute(
+                    "UPDATE users SET next_fire_at = ?, next_slot = ? WHERE chat_id = ? AND next_fire_at = ?",
+                    (*next_fire(u[U_TZ], u[U_TIMES], now), u[0], u[U_NEXT_FIRE]),
+                ).rowcount
+                if not claimed:
+                    continue
+                if u[U_NEXT_FIRE] < now - SLOT_MISFIRE_GRACE:
+                    skipped += 1
+                    continue
+                metrics.observe("reminder_lag_seconds", now - u[U_NEXT_FIRE])
+                label = REMINDER_SLOTS[u[U_NEXT_SLOT] or 0][1]
+                groups.setdefault((label, local_date(u[U_TZ], u[U_NEXT_FIRE])), []).append(u)
+            payloads = []
+            for (label, day), users in groups.items():
+                ids = open_reminders([u[0] for u in users], label, day)
+                payloads += [daily_payload(u, label, ids[u[0]]) for u in users]
+        # Keyingi bo'lak oldingisi yuborilayotganda tayyorlanadi
+        for f in pending:
+            if f.result():
+                sent += 1
+            else:
+                failed += 1
+        pending = [sender_pool.submit(send_with_retry, post_message, p["chat_id"], p) for p in payloads]
+    for f in pending:
+        if f.result():
+            sent += 1
+        else:
+            failed += 1
+    if sent or failed or skipped:
+        logging.info("reminders: sent=%s failed=%s skipped=%s", sent, failed, skipped)
+
+def ensure_jobs():
+    # Saqlangan ish o'zgarmagan bo'lsa qoldiriladi, aks holda next_run_time
+    # qayta hisoblanadi
+    job = scheduler.get_job("reminders")
+    if not job or job.trigger.interval.total_seconds() != REMINDER_TICK_SECONDS:
+        scheduler.add_job(
+            send_due_reminders, "interval", seconds=REMINDER_TICK_SECONDS, id="reminders",
+            replace_existing=True, misfire_grace_time=REMINDER_TICK_SECONDS,
+        )
+    from apscheduler.triggers.cron import CronTrigger
+
+    trigger = CronTrigger(hour=MAINTENANCE_HOUR, minute=30, second=0)
+    job = scheduler.get_job("maintenance")
+    if not job or str(job.trigger) != str(trigger):
+        scheduler.add_job(compact_progress, trigger, id="maintenance", replace_existing=True)
+
+def _job_label(job_id: str) -> str:
+    if job_id in ("reminders", "wakeup", "maintenance"):
+        return job_id
+    return "snooze"
+
+def _on_job_missed(event):
+    metrics.inc("scheduler_missed_total", job=_job_label(event.job_id))
+    logging.warning("job %s missed its run at %s", event.job_id, event.scheduled_run_time)
 
+def _on_job_submitted(event):
+    lag = (datetime.now(timezone.utc) - max(event.scheduled_run_times)).total_seconds()
+    metrics.observe("scheduler_lag_seconds", max(lag, 0.0), job=_job_label(event.job_id))
+
+@db_timed("get_progress_stats")
 def get_progress_stats(chat_id: int):
-    conn = db_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT SUM(done) as d, COUNT(*) as c FROM progress WHERE chat_id = ?", (chat_id,))
-    row = cur.fetchone()
-    conn.close()
-    done = row[0] or 0
-    total = row[1] or 0
-    return done, total
-
-@bot.message_handler(commands=["start"])
+    row = db_conn().execute("SELECT done, total FROM progress_totals WHERE chat_id = ?", (chat_id,)).fetchone()
+    if not row:
+        return 0, 0
+    return row[0] or 0, row[1] or 0
+
+@db_timed("get_global_stats")
+def get_global_stats():
+    row = db_conn().execute(
+        """
+        SELECT (SELECT value FROM counters WHERE name = 'users'), t.done, t.total
+        FROM (SELECT 1) LEFT JOIN progress_totals t ON t.chat_id = ?
+        """,
+        (TOTALS_ALL,),
+    ).fetchone()
+    return row[0] or 0, row[1] or 0, row[2] or 0
+
+@db_timed("get_stats_breakdown")
+def get_stats_breakdown(days: int = 7, chat_id=None):
+    # Umumiy statistika progress_global dan: foydalanuvchilar soniga bog'liq emas
+    since = (datetime.utcnow().date() - timedelta(days=days - 1)).isoformat()
+    if chat_id is None:
+        table, where, params = "progress_global", "date >= ?", (since,)
+    else:
+        table, where, params = "progress_daily", "chat_id = ? AND date >= ?", (chat_id, since)
+    out = {}
+    for key in ("label", "product", "date"):
+        out[key] = db_conn().execute(
+            f"SELECT {key}, SUM(done), SUM(total) FROM {table} WHERE {where} GROUP BY {key} ORDER BY {key}",
+            params,
+        ).fetchall()
+    return out
+
+def _format_breakdown(rows) -> str:
+    return "\n".join(f"• {k}: {d}/{t}" for k, d, t in rows) or "• -"
+
+def _timed_handler(fn):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        t = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            metrics.observe("handler_seconds", time.perf_counter() - t, handler=fn.__name__)
+    return wrapper
+
+class Router:
+    """Buyruqlar, tugma matnlari va callback_data uchun lug'at asosidagi yo'naltirish.
+
+    Jadval ishga tushishda bir marta to'ldiriladi; har bir xabar uchun
+    qidiruv doimiy vaqtda, menyular soniga bog'liq emas.
+    """
+
+    def __init__(self):
+        self.commands = {}
+        self.buttons = {}
+        self.callbacks = {}
+        self.fallback = None
+
+    def _register(self, table: dict, keys):
+        def deco(fn):
+            wrapped = _timed_handler(fn)
+            for key in keys:
+                if key in table:
+                    raise ValueError(f"route {key!r} already registered")
+                table[key] = wrapped
+            return fn
+        return deco
+
+    def command(self, *names):
+        return self._register(self.commands, names)
+
+    def button(self, *texts):
+        return self._register(self.buttons, texts)
+
+    def callback(self, *prefixes):
+        """callback_data ning birinchi ":" gacha bo'lgan qismi bo'yicha."""
+        return self._register(self.callbacks, prefixes)
+
+    def default(self, fn):
+        self.fallback = _timed_handler(fn)
+        return fn
+
+router = Router()
+
+@router.command("start")
 def start_handler(message: types.Message):
-    init_db()
     chat_id = message.chat.id
     u = get_user(chat_id)
     if not u:
         name = message.from_user.first_name or "Do'st"
         add_user(chat_id, name, None, None, None, "Painnoll", None)
-    schedule_user_jobs(chat_id)
     text = "Assalomu alaykum! Painnoll yordamchi botiga xush kelibsiz."
     bot.send_message(chat_id, text, reply_markup=main_kb)
 
-@bot.message_handler(commands=["admin"])
+@router.command("admin")
 def admin_entry(message: types.Message):
     if message.chat.id in ADMIN_IDS:
         bot.send_message(message.chat.id, "Admin panel", reply_markup=admin_kb)
     else:
         bot.send_message(message.chat.id, "Kirish rad etildi.")
 
-@bot.message_handler(func=lambda m: m.text == "👥 Foydalanuvchilar")
+def _filter_title(fcode: str) -> str:
+    if fcode[:1] == "p":
+        return PRODUCTS[int(fcode[1:])]
+    if fcode[:1] == "i":
+        return ISSUES[int(fcode[1:])]
+    if fcode[:1] == "q":
+        return f"qidiruv: {fcode[1:]}"
+    return ""
+
+def render_users_page(cursor=None, backward: bool = False, fcode: str = ""):
+    rows, more = list_users_page(cursor, backward, fcode)
+    has_prev = more if backward else cursor is not None
+    has_next = True if backward else more
+    title = "👥 Foydalanuvchilar"
+    if fcode:
+        title += f" ({html.escape(_filter_title(fcode), quote=False)})"
+    esc = functools.partial(html.escape, quote=False)
+    lines = [f"{cid} | {esc(name or '-')} | {esc(product or '-')} | {esc(issue or '-')}" for cid, name, product, issue in rows]
+    text = title + "\n\n" + ("\n".join(lines) or "Hech narsa topilmadi.")
+    kb = types.InlineKeyboardMarkup()
+    nav = []
+    if rows and has_prev:
+        nav.append(types.InlineKeyboardButton("⬅️", callback_data=f"au:p:{rows[0][0]}:{fcode}"))
+    if rows and has_next:
+        nav.append(types.InlineKeyboardButton("➡️", callback_data=f"au:n:{rows[-1][0]}:{fcode}"))
+    if nav:
+        kb.row(*nav)
+    kb.row(*[types.InlineKeyboardButton(p, callback_data=f"au:f::p{i}") for i, p in enumerate(PRODUCTS)])
+    kb.row(*[types.InlineKeyboardButton(issue.split(" ", 1)[1], callback_data=f"au:f::i{i}") for i, issue in enumerate(ISSUES)])
+    if fcode:
+        kb.row(types.InlineKeyboardButton("✖️ Filtrsiz", callback_data="au:f::"))
+    return text, kb
+
+@router.button("👥 Foydalanuvchilar")
 def admin_users(message: types.Message):
     if message.chat.id not in ADMIN_IDS:
         return
-    ids = list_user_ids()
-    bot.send_message(message.chat.id, f"Foydalanuvchilar soni: {len(ids)}")
-    for cid in ids[:20]:
-        u = get_user(cid)
-        if u:
-            bot.send_message(message.chat.id, f"{cid} | {u[1]} | {u[5] or '-'} | {u[6] or '-'}")
-
-@bot.message_handler(func=lambda m: m.text == "📈 Statistika")
+    text, kb = render_users_page()
+    bot.send_message(message.chat.id, text, reply_markup=kb)
+
+@router.command("users")
+def admin_users_search(message: types.Message):
+    if message.chat.id not in ADMIN_IDS:
+        return
+    parts = message.text.split(maxsplit=1)
+    fcode = ""
+    if len(parts) > 1:
+        # callback_data 64 baytdan oshmasligi kerak
+        q = parts[1].strip()[:24]
+        while len(f"au:n:-1000000000000:q{q}".encode("utf-8")) > 64:
+            q = q[:-1]
+        fcode = f"q{q}" if q else ""
+    text, kb = render_users_page(fcode=fcode)
+    bot.send_message(message.chat.id, text, reply_markup=kb)
+
+@router.callback("au")
+def admin_users_page(callback_query: types.CallbackQuery):
+    if callback_query.message.chat.id not in ADMIN_IDS:
+        bot.answer_callback_query(callback_query.id)
+        return
+    _, direction, cursor, fcode = callback_query.data.split(":", 3)
+    text, kb = render_users_page(int(cursor) if cursor else None, direction == "p", fcode)
+    try:
+        bot.edit_message_text(text, callback_query.message.chat.id, callback_query.message.message_id, reply_markup=kb)
+    except ApiTelegramException as e:
+        # "message is not modified" — shu sahifa qayta bosilgan
+        logging.debug("users page edit: %s", e)
+    bot.answer_callback_query(callback_query.id)
+
+@router.button("📈 Statistika")
 def admin_stats(message: types.Message):
     if message.chat.id not in ADMIN_IDS:
         return
-    ids = list_user_ids()
-    total = len(ids)
-    done_total = 0
-    logs_total = 0
-    for cid in ids:
-        d, t = get_progress_stats(cid)
-        done_total += d
-        logs_total += t
-    bot.send_message(message.chat.id, f"Umumiy foydalanuvchilar: {total}\nAmallar: {done_total}/{logs_total}")
-
-@bot.message_handler(func=lambda m: m.text == "📣 Anons yuborish")
+    total, done_total, logs_total = get_global_stats()
+    b = get_stats_breakdown(7)
+    text = (
+        f"Umumiy foydalanuvchilar: {total}\nAmallar: {done_total}/{logs_total}\n\n"
+        f"Oxirgi 7 kun, vaqt bo'yicha:\n{_format_breakdown(b['label'])}\n\n"
+        f"Mahsulot bo'yicha:\n{_format_breakdown(b['product'])}\n\n"
+        f"Kunlar bo'yicha:\n{_format_breakdown(b['date'])}\n\n"
+        "Kesh: {hits} hit / {misses} miss ({hit_ratio:.0%}), {size} ta profil".format(**user_cache.stats())
+    )
+    bot.send_message(message.chat.id, text)
+
+EXPORT_USAGE = (
+    "Foydalanish: /export users|progress [csv|jsonl] [gz] "
+    "[from=YYYY-MM-DD] [to=YYYY-MM-DD] [product=Painnoll] [issue=1-4]"
+)
+
+def parse_export_args(text: str):
+    args = text.split()[1:]
+    opts = {"table": None, "fmt": "csv", "compress": False, "filters": {}}
+    for a in args:
+        key, _, val = a.partition("=")
+        if a in EXPORT_TABLES:
+            opts["table"] = a
+        elif a in ("csv", "jsonl"):
+            opts["fmt"] = a
+        elif a == "gz":
+            opts["compress"] = True
+        elif key in ("from", "to") and val:
+            datetime.fromisoformat(val)
+            opts["filters"]["date_" + key] = val
+        elif key == "product" and val:
+            opts["filters"]["product"] = val
+        elif key == "issue" and val.isdigit() and 1 <= int(val) <= len(ISSUES):
+            opts["filters"]["issue"] = ISSUES[int(val) - 1]
+        else:
+            raise ValueError(a)
+    if not opts["table"]:
+        raise ValueError("table")
+    return opts
+
+def run_export(chat_id: int, opts: dict):
+    name = f"{opts['table']}-{datetime.utcnow():%Y%m%d-%H%M%S}.{opts['fmt']}" + (".gz" if opts["compress"] else "")
+    try:
+        with tempfile.SpooledTemporaryFile(max_size=4 * 1024 * 1024) as f:
+            count = write_export(f, opts["table"], opts["fmt"], opts["compress"], **opts["filters"])
+            f.seek(0)
+            bot.send_document(chat_id, f, visible_file_name=name, caption=f"{opts['table']}: {count} ta yozuv")
+    except Exception as e:
+        logging.exception("export failed: %s", e)
+        bot.send_message(chat_id, "Eksport xatosi.")
+
+@router.command("export")
+def admin_export(message: types.Message):
+    if message.chat.id not in ADMIN_IDS:
+        return
+    try:
+        opts = parse_export_args(message.text)
+    except ValueError:
+        bot.send_message(message.chat.id, EXPORT_USAGE)
+        return
+    bot.send_message(message.chat.id, "Eksport tayyorlanmoqda...")
+    threading.Thread(target=run_export, args=(message.chat.id, opts), name="export", daemon=True).start()
+
+@router.button("📣 Anons yuborish")
 def admin_broadcast_start(message: types.Message):
     if message.chat.id not in ADMIN_IDS:
         return
-    admin_modes[message.chat.id] = "broadcast"
+    set_state(message.chat.id, "broadcast")
     bot.send_message(message.chat.id, "Anons matnini yuboring:")
 
-@bot.message_handler(func=lambda m: admin_modes.get(m.chat.id) == "broadcast")
-def admin_broadcast_do(message: types.Message):
+def admin_broadcast_do(message: types.Message, data: dict):
+    clear_state(message.chat.id)
     if message.chat.id not in ADMIN_IDS:
         return
-    text = message.text
-    ids = list_user_ids()
-    cnt = 0
-    for cid in ids:
-        try:
-            bot.send_message(cid, text)
-            cnt += 1
-        except Exception:
-            pass
-    admin_modes.pop(message.chat.id, None)
-    bot.send_message(message.chat.id, f"Yuborildi: {cnt}")
+    if message.text == "⬅️ Orqaga":
+        bot.send_message(message.chat.id, "Anons bekor qilindi.", reply_markup=admin_kb)
+        return
+    if message.text in ADMIN_BUTTONS:
+        # Admin tugmasi anons matni emas: anons bekor, tugma odatdagidek ishlaydi
+        router.buttons[message.text](message)
+        return
+    bid, total = create_broadcast(message.chat.id, "text", message.text)
+    msg = bot.send_message(message.chat.id, f"Anons navbatga qo'yildi: {total} ta foydalanuvchi.")
+    set_broadcast_report(bid, msg.message_id)
+    broadcaster.kick()
 
-@bot.message_handler(func=lambda m: m.text == "💊 Mahsulotlar")
+@router.button("💊 Mahsulotlar")
 def products_menu(message: types.Message):
     bot.send_message(message.chat.id, "Mahsulotni tanlang:", reply_markup=product_kb)
 
-@bot.message_handler(func=lambda m: m.text in {"🌿 Painnoll", "🍃 BioDetox", "💪 VitaPro", "🔬 NutraMax"})
+@router.button(*PRODUCT_BUTTONS)
 def product_set(message: types.Message):
     chat_id = message.chat.id
-    update_user_field(chat_id, "product", message.text.replace("🌿 ", "").replace("🍃 ", "").replace("💪 ", "").replace("🔬 ", ""))
-    schedule_user_jobs(chat_id)
+    update_user_field(chat_id, "product", PRODUCT_BUTTONS[message.text])
     bot.send_message(chat_id, "Registratsiya tugadi. Rejalashtirish yoqildi.", reply_markup=main_kb)
 
-@bot.message_handler(func=lambda m: m.text == "📝 Mening profilim")
+@router.button("📝 Mening profilim")
 def my_profile(message: types.Message):
     u = get_user(message.chat.id)
     if not u:
@@ -330,80 +1807,141 @@ def my_profile(message: types.Message):
         f"Bo'y: {height or '-'}\n"
         f"Mahsulot: {product or '-'}\n"
         f"Muammo: {issue or '-'}\n"
-        f"Hafta: {week or 1}"
+        f"Hafta: {week or 1}\n"
+        f"Eslatmalar: {describe_schedule(u)}"
     )
     bot.send_message(message.chat.id, text, reply_markup=issue_kb)
 
-@bot.message_handler(func=lambda m: m.text == "🩺 Registratsiya")
+SCHEDULE_USAGE = (
+    "Eslatma vaqtlari: /vaqt +5 08:00 13:00 19:00\n"
+    "Vaqt mintaqasi UTC ga nisbatan (+5, -3:30), vaqtlar mahalliy, "
+    f"{len(REMINDER_SLOTS)} ta (ertalab, tushlik, kechqurun)."
+)
+
+def format_tz(minutes: int) -> str:
+    h, m = divmod(abs(minutes), 60)
+    return f"UTC{'-' if minutes < 0 else '+'}{h}" + (f":{m:02d}" if m else "")
+
+def describe_schedule(u) -> str:
+    tz = DEFAULT_TZ_MINUTES if u[U_TZ] is None else u[U_TZ]
+    return f"{format_tz(tz)}, " + format_times(parse_times(u[U_TIMES])).replace(",", ", ")
+
+def parse_schedule_args(text: str, tz_offset, times):
+    """/vaqt argumentlari: [+H[:MM]] [HH:MM ...]; noto'g'ri bo'lsa ValueError."""
+    new_times = []
+    for a in text.split()[1:]:
+        if a[0] in "+-":
+            h, sep, m = a[1:].partition(":")
+            # Faqat raqamlar: "+5:-3" yoki "+-5" qabul qilinmaydi
+            if not h.isdigit() or (sep and not (m.isdigit() and int(m) < 60)):
+                raise ValueError(a)
+            tz_offset = (int(h) * 60 + int(m or 0)) * (-1 if a[0] == "-" else 1)
+            if not -12 * 60 <= tz_offset <= 14 * 60:
+                raise ValueError(a)
+        else:
+            h, m = a.split(":")
+            new_times.append(datetime.strptime(f"{h}:{m}", "%H:%M"))
+    if new_times:
+        minutes = {t.hour * 60 + t.minute for t in new_times}
+        # Takroriy vaqtlar ham rad etiladi: aks holda kuniga bitta eslatma qolardi
+        if len(minutes) != len(new_times) or len(new_times) != len(REMINDER_SLOTS):
+            raise ValueError("times")
+        times = format_times(sorted(minutes))
+    return tz_offset, times
+
+@router.command("vaqt")
+def schedule_settings(message: types.Message):
+    chat_id = message.chat.id
+    u = get_user(chat_id)
+    if not u:
+        bot.send_message(chat_id, "Avval /start ni bosing.")
+        return
+    try:
+        tz_offset, times = parse_schedule_args(message.text, u[U_TZ], u[U_TIMES])
+    except ValueError:
+        bot.send_message(chat_id, SCHEDULE_USAGE)
+        return
+    if (tz_offset, times) != (u[U_TZ], u[U_TIMES]):
+        set_schedule(chat_id, tz_offset, times)
+        u = get_user(chat_id)
+    bot.send_message(chat_id, f"Eslatmalar: {describe_schedule(u)}\n\n{SCHEDULE_USAGE}")
+
+@router.button("🩺 Registratsiya")
 def start_registration(message: types.Message):
-    msg = bot.send_message(message.chat.id, "Ismingizni kiriting:")
-    bot.register_next_step_handler(msg, reg_name)
+    set_state(message.chat.id, "reg_name")
+    bot.send_message(message.chat.id, "Ismingizni kiriting:")
 
-def reg_name(message: types.Message):
-    name = message.text.strip()
-    add_user(message.chat.id, name)
-    msg = bot.send_message(message.chat.id, "Yoshingizni kiriting (yil):")
-    bot.register_next_step_handler(msg, reg_age)
+def reg_name(message: types.Message, data: dict):
+    data["name"] = message.text.strip()
+    set_state(message.chat.id, "reg_age", data)
+    bot.send_message(message.chat.id, "Yoshingizni kiriting (yil):")
 
-def reg_age(message: types.Message):
+def reg_age(message: types.Message, data: dict):
     try:
-        age = int(message.text.strip())
+        data["age"] = int(message.text.strip())
     except Exception:
-        msg = bot.send_message(message.chat.id, "Yosh noto'g'ri. Raqam kiriting:")
-        bot.register_next_step_handler(msg, reg_age)
+        bot.send_message(message.chat.id, "Yosh noto'g'ri. Raqam kiriting:")
         return
-    update_user_field(message.chat.id, "age", age)
-    msg = bot.send_message(message.chat.id, "Vazningizni kiriting (kg):")
-    bot.register_next_step_handler(msg, reg_weight)
+    set_state(message.chat.id, "reg_weight", data)
+    bot.send_message(message.chat.id, "Vazningizni kiriting (kg):")
 
-def reg_weight(message: types.Message):
+def reg_weight(message: types.Message, data: dict):
     try:
-        weight = float(message.text.strip().replace(',', '.'))
+        data["weight"] = float(message.text.strip().replace(',', '.'))
     except Exception:
-        msg = bot.send_message(message.chat.id, "Vazn noto'g'ri. Raqam kiriting:")
-        bot.register_next_step_handler(msg, reg_weight)
+        bot.send_message(message.chat.id, "Vazn noto'g'ri. Raqam kiriting:")
         return
-    update_user_field(message.chat.id, "weight", weight)
-    msg = bot.send_message(message.chat.id, "Bo'yingizni kiriting (sm):")
-    bot.register_next_step_handler(msg, reg_height)
+    set_state(message.chat.id, "reg_height", data)
+    bot.send_message(message.chat.id, "Bo'yingizni kiriting (sm):")
 
-def reg_height(message: types.Message):
+def reg_height(message: types.Message, data: dict):
     try:
-        height = float(message.text.strip().replace(',', '.'))
+        data["height"] = float(message.text.strip().replace(',', '.'))
     except Exception:
-        msg = bot.send_message(message.chat.id, "Bo'y noto'g'ri. Raqam kiriting:")
-        bot.register_next_step_handler(msg, reg_height)
+        bot.send_message(message.chat.id, "Bo'y noto'g'ri. Raqam kiriting:")
         return
-    update_user_field(message.chat.id, "height", height)
+    save_profile(message.chat.id, data)
     bot.send_message(message.chat.id, "Muammo turini tanlang:", reply_markup=issue_kb)
 
-@bot.message_handler(func=lambda m: m.text in {"🦵 Suyak va bo'g'imlar", "🍽 Oshqozon / hazm", "🧔 Prostata", "🍋 Detoks / vazn"})
+STATE_HANDLERS = {
+    "reg_name": reg_name,
+    "reg_age": reg_age,
+    "reg_weight": reg_weight,
+    "reg_height": reg_height,
+    "broadcast": admin_broadcast_do,
+}
+
+@router.button(*ISSUES)
 def issue_set(message: types.Message):
     chat_id = message.chat.id
     update_user_field(chat_id, "issue", message.text)
     bot.send_message(chat_id, "Mahsulotni tanlang:", reply_markup=product_kb)
 
-@bot.message_handler(func=lambda m: m.text == "🍽 Ovqatlanish")
+@router.button("🍽 Ovqatlanish")
 def meals_info(message: types.Message):
     u = get_user(message.chat.id)
     s = simple_meal_suggestion(u[6] if u else None)
     bot.send_message(message.chat.id, f"Bugungi tavsiya: {s}", reply_markup=main_kb)
 
-@bot.message_handler(func=lambda m: m.text == "📊 Natijam")
+@router.button("📊 Natijam")
 def my_stats(message: types.Message):
     d, t = get_progress_stats(message.chat.id)
-    bot.send_message(message.chat.id, f"Bajarilgan amal: {d}/{t}")
+    b = get_stats_breakdown(7, message.chat.id)
+    bot.send_message(
+        message.chat.id,
+        f"Bajarilgan amal: {d}/{t}\n\nOxirgi 7 kun:\n{_format_breakdown(b['label'])}",
+    )
 
-@bot.message_handler(func=lambda m: m.text == "📞 Bog'lanish")
+@router.button("📞 Bog'lanish")
 def contact_info(message: types.Message):
     set_consult_mode(message.chat.id, True)
     bot.send_message(message.chat.id, "Men Nutresolog Sardor Xasanovich. Savolingizni yozing va javob beraman.")
 
-@bot.message_handler(func=lambda m: m.text == "🎁 Aksiya")
+@router.button("🎁 Aksiya")
 def promo_info(message: types.Message):
     bot.send_message(message.chat.id, "Aksiya: Bugun buyurtmaga maxsus chegirma mavjud.")
 
-@bot.message_handler(func=lambda m: m.text not in {"📝 Mening profilim", "🍽 Ovqatlanish", "💊 Mahsulotlar", "📊 Natijam", "📞 Bog'lanish", "🎁 Aksiya", "⬅️ Orqaga", "🩺 Registratsiya", "👥 Foydalanuvchilar", "📈 Statistika", "📣 Anons yuborish"})
+@router.default
 def ai_catch_all(message: types.Message):
     if get_consult_mode(message.chat.id):
         u = get_user(message.chat.id)
@@ -414,125 +1952,593 @@ def ai_catch_all(message: types.Message):
 def on_photo(message: types.Message):
     cap = message.caption or ""
     text = f"Rasm: {message.chat.id} | {message.from_user.first_name or ''} | {cap}"
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_photo(aid, message.photo[-1].file_id, caption=text)
-        except Exception:
-            pass
+    create_broadcast(None, "photo", text, message.photo[-1].file_id, targets=ADMIN_IDS, priority=0)
+    broadcaster.kick()
     bot.send_message(message.chat.id, "Rasm qabul qilindi.")
 
 @bot.message_handler(content_types=["video"]) 
 def on_video(message: types.Message):
     cap = message.caption or ""
     text = f"Video: {message.chat.id} | {message.from_user.first_name or ''} | {cap}"
-    for aid in ADMIN_IDS:
-        try:
-            bot.send_video(aid, message.video.file_id, caption=text)
-        except Exception:
-            pass
+    create_broadcast(None, "video", text, message.video.file_id, targets=ADMIN_IDS, priority=0)
+    broadcaster.kick()
     bot.send_message(message.chat.id, "Video qabul qilindi.")
 
-@bot.message_handler(func=lambda m: m.text == "⬅️ Orqaga")
+@router.button("⬅️ Orqaga")
 def back_to_main(message: types.Message):
     bot.send_message(message.chat.id, "Asosiy menyu.", reply_markup=main_kb)
     set_consult_mode(message.chat.id, False)
 
-@bot.callback_query_handler(func=lambda c: c.data in {"done", "remind_later"})
+def reminder_action(chat_id: int, row, snooze: bool) -> str:
+    """Eslatma yozuvi bo'yicha tugmani bajaradi va foydalanuvchiga javob matnini qaytaradi."""
+    rid, day, label, status, snoozes, snooze_until = row
+    if not snooze:
+        with db_tx() as conn:
+            if not conn.execute(
+                "UPDATE reminders SET status = ? WHERE id = ? AND status != ?", (REMINDER_DONE, rid, REMINDER_DONE)
+            ).rowcount:
+                return "Allaqachon belgilangan"
+            log_progress(chat_id, label, True, day)
+        if status == REMINDER_SNOOZED:
+            from apscheduler.jobstores.base import JobLookupError
+
+            try:
+                scheduler.remove_job(f"snooze-{rid}")
+            except JobLookupError:
+                pass
+        return "Bajarildi"
+    now = time.time()
+    if status == REMINDER_DONE:
+        return "Bu eslatma bajarilgan"
+    if snooze_until and snooze_until > now:
+        return "Keyinroq eslatiladi"
+    if snoozes >= SNOOZE_MAX:
+        return "Bu eslatmani boshqa kechiktirib bo'lmaydi"
+    run_at = now + SNOOZE_MINUTES * 60
+    with db_tx() as conn:
+        used = conn.execute(
+            "SELECT COALESCE(SUM(snoozes), 0) FROM reminders WHERE chat_id = ? AND date = ?", (chat_id, day)
+        ).fetchone()[0]
+        if used >= SNOOZE_DAILY_MAX:
+            return "Bugun uchun eslatmalar limiti tugadi"
+        conn.execute(
+            "UPDATE reminders SET status = ?, snoozes = snoozes + 1, snooze_until = ? WHERE id = ?",
+            (REMINDER_SNOOZED, run_at, rid),
+        )
+        if status == REMINDER_SENT:
+            log_progress(chat_id, label, False, day)
+    # Ish tranzaksiyadan keyin qo'shiladi: jobstore bazaga alohida ulanish bilan yozadi
+    scheduler.add_job(
+        send_snoozed_reminder, "date", run_date=datetime.fromtimestamp(run_at, timezone.utc),
+        args=[chat_id, rid], id=f"snooze-{rid}", replace_existing=True,
+        misfire_grace_time=SNOOZE_MISFIRE_GRACE,
+    )
+    return "Keyinroq eslatiladi"
+
+@router.callback("rd", "rs")
+def reminder_buttons(callback_query: types.CallbackQuery):
+    chat_id = callback_query.message.chat.id
+    rid = callback_query.data.split(":", 1)[1]
+    row = get_reminder(int(rid), chat_id) if rid.isdigit() else None
+    if not row:
+        bot.answer_callback_query(callback_query.id, "Eslatma topilmadi")
+        return
+    bot.answer_callback_query(callback_query.id, reminder_action(chat_id, row, callback_query.data.startswith("rs")))
+
+@router.callback("done", "remind_later")
 def inline_actions(callback_query: types.CallbackQuery):
+    # Eski xabarlardagi tugmalar: vaqt matndan olinadi, yozuv bugungi kunga ochiladi
     chat_id = callback_query.message.chat.id
     text = callback_query.message.text or ""
-    label = ""
-    if "Ertalab" in text:
-        label = "Ertalab"
-    elif "Tushlik" in text:
-        label = "Tushlik"
-    elif "Kechqurun" in text:
-        label = "Kechqurun"
-    else:
-        label = "Eslatma"
-    if callback_query.data == "done":
-        log_progress(chat_id, label, True)
-        bot.answer_callback_query(callback_query.id, "Bajarildi")
-    else:
-        run_at = datetime.utcnow() + timedelta(minutes=30)
-        scheduler.add_job(send_daily_message, "date", run_date=run_at, args=[chat_id, label])
-        log_progress(chat_id, label, False)
-        bot.answer_callback_query(callback_query.id, "Keyinroq eslatiladi")
-
-def start_scheduler_for_all():
-    for cid in list_user_ids():
-        schedule_user_jobs(cid)
-    try:
-        scheduler.start()
-    except Exception:
-        pass
+    label = next((lb for _, lb in REMINDER_SLOTS if lb in text), "Eslatma")
+    rid = open_reminders([chat_id], label)[chat_id]
+    row = get_reminder(rid, chat_id)
+    bot.answer_callback_query(callback_query.id, reminder_action(chat_id, row, callback_query.data == "remind_later"))
+
+def scheduler_wakeup():
+    # Boshqa jarayonlar bazaga qo'shgan ishlarni lider shu oraliqda ko'radi
+    pass
+
+def start_scheduler(paused: bool = False):
+    # To'xtatilgan (paused) holatda ham add_job umumiy bazaga yozadi,
+    # shuning uchun lider bo'lmagan jarayonlar ham snooze qo'sha oladi.
+    from apscheduler.events import EVENT_JOB_MISSED, EVENT_JOB_SUBMITTED
+
+    scheduler.add_listener(_on_job_missed, EVENT_JOB_MISSED)
+    scheduler.add_listener(_on_job_submitted, EVENT_JOB_SUBMITTED)
+    for attempt in range(3):
+        try:
+            scheduler.start(paused=paused)
+            break
+        except Exception as e:
+            # Bir nechta jarayon scheduler_jobs jadvalini bir vaqtda yaratishi mumkin
+            if attempt == 2:
+                logging.exception("scheduler start failed: %s", e)
+                return
+            time.sleep(0.5)
+    if not paused:
+        ensure_jobs()
+
+def acquire_lease(name: str, owner: str, ttl: float) -> bool:
+    now = time.time()
+    with db_tx() as conn:
+        row = conn.execute("SELECT owner, expires_at FROM leases WHERE name = ?", (name,)).fetchone()
+        if row and row[0] != owner and row[1] > now:
+            return False
+        conn.execute(
+            """
+            INSERT INTO leases (name, owner, expires_at) VALUES (?, ?, ?)
+            ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+            """,
+            (name, owner, now + ttl),
+        )
+    return True
+
+def release_lease(name: str, owner: str):
+    db_conn().execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+class LeaderElector:
+    """Bazadagi lease orqali bitta jarayonni lider qiladi.
+
+    Lider scheduler va broadcasterni ishga tushiradi; lease yangilanmasa
+    (jarayon o'lgan yoki osilib qolgan) LEASE_TTL dan keyin boshqasi oladi.
+    """
+
+    def __init__(self, name: str = "leader"):
+        self.name = name
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        self.is_leader = False
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self.owner = f"{socket.gethostname()}:{os.getpid()}"
+        metrics.gauge("leader", lambda: int(self.is_leader))
+        self._tick()
+        self._thread = threading.Thread(target=self._run, name="leader", daemon=True)
+        self._thread.start()
+        atexit.register(self.release)
+
+    def release(self):
+        if self.is_leader:
+            try:
+                release_lease(self.name, self.owner)
+            except Exception:
+                pass
+
+    def _run(self):
+        while True:
+            time.sleep(LEASE_TTL / 3)
+            self._tick()
+
+    def _tick(self):
+        try:
+            leader = acquire_lease(self.name, self.owner, LEASE_TTL)
+        except Exception as e:
+            logging.warning("lease renew failed: %s", e)
+            leader = False
+        if leader and not self.is_leader:
+            self.is_leader = True
+            logging.info("%s is now the leader", self.owner)
+            self._promote()
+        elif not leader and self.is_leader:
+            self.is_leader = False
+            logging.warning("%s lost leadership", self.owner)
+            self._demote()
+
+    def _promote(self):
+        try:
+            if not scheduler.running:
+                start_scheduler()
+            else:
+                scheduler.resume()
+                ensure_jobs()
+            scheduler.add_job(scheduler_wakeup, "interval", seconds=LEASE_TTL, id="wakeup", replace_existing=True)
+        except Exception as e:
+            logging.exception("leader scheduler start failed: %s", e)
+        broadcaster.active = True
+        broadcaster.start()
+        broadcaster.kick()
+
+    def _demote(self):
+        broadcaster.active = False
+        try:
+            scheduler.pause()
+        except Exception as e:
+            logging.warning("scheduler pause failed: %s", e)
+
+elector = LeaderElector()
+
+@bot.message_handler(content_types=["text"])
+def route_text(message: types.Message):
+    text = message.text
+    if text.startswith("/"):
+        name = text.split(maxsplit=1)[0][1:].split("@", 1)[0].lower()
+        handler = router.commands.get(name) or router.fallback
+        if handler is not None:
+            handler(message)
+        return
+    state, data = get_state(message.chat.id)
+    if state is not None:
+        handler = STATE_HANDLERS.get(state)
+        if handler is None:
+            clear_state(message.chat.id)
+        else:
+            handler(message, dict(data))
+        return
+    handler = router.buttons.get(text) or router.fallback
+    if handler is not None:
+        handler(message)
+
+@bot.callback_query_handler(func=lambda c: True)
+def route_callback(callback_query: types.CallbackQuery):
+    handler = router.callbacks.get((callback_query.data or "").split(":", 1)[0])
+    if handler is None:
+        bot.answer_callback_query(callback_query.id)
+        return
+    handler(callback_query)
+
+def _update_chat_id(data: dict):
+    for key in ("message", "edited_message", "callback_query"):
+        obj = data.get(key)
+        if not obj:
+            continue
+        if key == "callback_query":
+            msg = obj.get("message") or {}
+            return (msg.get("chat") or {}).get("id") or (obj.get("from") or {}).get("id")
+        return (obj.get("chat") or {}).get("id")
+    return data.get("update_id")
+
+def _shard_key(data: dict) -> int:
+    key = _update_chat_id(data)
+    return key if isinstance(key, int) else 0
+
+class SeenUpdates:
+    """update_id va callback_query.id bo'yicha takroriy yangilanishlarni aniqlaydi.
+
+    Kalitlar xotirada (hajmi SEEN_MAX, muddati SEEN_TTL) saqlanadi va bazaga
+    to'plab yoziladi, shuning uchun qayta ishga tushgandan keyin ham ishlaydi.
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._keys = OrderedDict()
+        self._pending = []
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._flushed = 0.0
+        self._pruned = 0.0
+
+    @staticmethod
+    def keys(data: dict):
+        keys = [f"u:{data.get('update_id')}"]
+        cq = data.get("callback_query")
+        if cq and cq.get("id"):
+            keys.append(f"c:{cq['id']}")
+        return keys
+
+    def seen(self, data: dict) -> bool:
+        """Yangilanish avval ko'rilgan bo'lsa True; aks holda uni belgilaydi."""
+        now = time.time()
+        keys = self.keys(data)
+        with self._lock:
+            if not self._loaded:
+                self._load(now)
+            self._evict(now)
+            if any(k in self._keys for k in keys):
+                return True
+            for k in keys:
+                self._keys[k] = now
+                self._pending.append((k, now))
+            if now - self._flushed < SEEN_FLUSH_SECONDS:
+                return False
+            self._flushed = now
+            pending, self._pending = self._pending, []
+        self._flush(pending, now)
+        return False
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        self._flush(pending, time.time())
+
+    def _load(self, now: float):
+        self._loaded = True
+        rows = db_conn().execute(
+            "SELECT key, seen_at FROM seen_updates WHERE seen_at >= ? ORDER BY seen_at DESC LIMIT ?",
+            (now - self.ttl, self.maxsize),
+        ).fetchall()
+        for key, at in reversed(rows):
+            self._keys[key] = at
+
+    def _evict(self, now: float):
+        keys = self._keys
+        while keys:
+            key, at = next(iter(keys.items()))
+            if len(keys) <= self.maxsize and at >= now - self.ttl:
+                break
+            keys.popitem(last=False)
+
+    def _flush(self, pending, now: float):
+        try:
+            with db_tx() as conn:
+                if pending:
+                    conn.executemany("INSERT OR IGNORE INTO seen_updates (key, seen_at) VALUES (?, ?)", pending)
+                if now - self._pruned >= 60:
+                    self._pruned = now
+                    conn.execute("DELETE FROM seen_updates WHERE seen_at < ?", (now - self.ttl,))
+        except Exception as e:
+            logging.warning("seen_updates flush failed: %s", e)
+
+seen_updates = SeenUpdates(SEEN_MAX, SEEN_TTL)
+atexit.register(seen_updates.flush)
+
+class UpdateDispatcher:
+    """Yangilanishlarni chat_id bo'yicha oqimlarga taqsimlaydi.
+
+    Har bir oqimning o'z chegaralangan navbati bor: bitta chat doim bitta
+    oqimga tushadi, navbat to'lsa submit() False qaytaradi.
+    """
+
+    def __init__(self, workers: int, queue_size: int):
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        for i, q in enumerate(self.queues):
+            t = threading.Thread(target=self._work, args=(q,), name=f"updates-{i}", daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, data: dict, block: bool = False) -> bool:
+        # Jarayonlar chat_id % WORKER_PROCESSES bo'yicha bo'lingan, oqimlar
+        # esa qolgan bo'lak bo'yicha: aks holda ba'zi oqimlar bo'sh qoladi.
+        q = self.queues[(_shard_key(data) // WORKER_PROCESSES) % len(self.queues)]
+        try:
+            q.put(data, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def _work(self, q: queue.Queue):
+        while True:
+            data = q.get()
+            if seen_updates.seen(data):
+                # Telegram qayta yuborgan: progress va snooze ikki marta yozilmaydi
+                metrics.inc("duplicate_updates_total")
+                continue
+            t = time.perf_counter()
+            try:
+                bot.process_new_updates([types.Update.de_json(data)])
+            except Exception as e:
+                metrics.inc("update_errors_total")
+                logging.exception("update %s failed: %s", data.get("update_id"), e)
+            metrics.observe("update_seconds", time.perf_counter() - t)
+
+dispatcher = UpdateDispatcher(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+
+def warm_up():
+    # APScheduler importi, jobstore va lease — trafikni qabul qilishni kutdirmaydi
+    t = time.perf_counter()
+    start_scheduler(paused=True)
+    elector.start()
+    logging.info("scheduler warm-up done in %.2fs", time.perf_counter() - t)
+
+def start_warm_up():
+    threading.Thread(target=warm_up, name="warm-up", daemon=True).start()
+
+def _push_metrics(index: int, metrics_q):
+    while True:
+        time.sleep(METRICS_PUSH_SECONDS)
+        try:
+            metrics_q.put_nowait((index, metrics.snapshot()))
+        except queue.Full:
+            pass
+
+def _worker_main(index: int, q, metrics_q):
+    # Alohida jarayon: o'z oqimlari, scheduler va lease tekshiruvi bilan.
+    # Metrikalar asosiy jarayonning /metrics ida worker yorlig'i bilan chiqadi.
+    logging.info("worker %s started (pid %s)", index, os.getpid())
+    dispatcher.start()
+    start_warm_up()
+    threading.Thread(target=_push_metrics, args=(index, metrics_q), name="metrics-push", daemon=True).start()
+    while True:
+        dispatcher.submit(q.get(), block=True)
+
+class ShardedWorkers:
+    """Yangilanishlarni chat_id % n bo'yicha n ta jarayonga yuboradi.
+
+    Bitta chat doim bitta jarayonga tushadi, shuning uchun uning holati
+    va keshi boshqa jarayonlar bilan to'qnashmaydi. O'lgan jarayon qayta
+    ishga tushiriladi.
+    """
+
+    def __init__(self, n: int, queue_size: int):
+        self._ctx = multiprocessing.get_context("spawn")
+        self.queues = [self._ctx.Queue(maxsize=queue_size) for _ in range(n)]
+        self.metrics_q = self._ctx.Queue(maxsize=n * 4)
+        self.procs = [None] * n
+
+    def start(self):
+        for i in range(len(self.queues)):
+            self._spawn(i)
+        threading.Thread(target=self._watch, name="workers", daemon=True).start()
+        threading.Thread(target=self._collect, name="metrics-collect", daemon=True).start()
+
+    def _spawn(self, i: int):
+        p = self._ctx.Process(
+            target=_worker_main, args=(i, self.queues[i], self.metrics_q), name=f"worker-{i}", daemon=True
+        )
+        p.start()
+        self.procs[i] = p
+
+    def _watch(self):
+        while True:
+            time.sleep(5)
+            for i, p in enumerate(self.procs):
+                if not p.is_alive():
+                    metrics.inc("worker_restarts_total")
+                    logging.error("worker %s exited with %s, restarting", i, p.exitcode)
+                    self._spawn(i)
+
+    def _collect(self):
+        while True:
+            try:
+                metrics.merge(*self.metrics_q.get())
+            except Exception as e:
+                logging.warning("worker metrics receive failed: %s", e)
+
+    def submit(self, data: dict, block: bool = False) -> bool:
+        q = self.queues[_shard_key(data) % len(self.queues)]
+        try:
+            q.put(data, block=block)
+        except queue.Full:
+            return False
+        return True
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+# Kiruvchi yangilanishlar shu yerga beriladi: bitta jarayonda dispatcher,
+# WORKER_PROCESSES > 1 bo'lsa ShardedWorkers
+ingress = dispatcher
+
+def instrument():
+    # route_text/route_callback ichidagi handlerlar Router da o'lchanadi: ikki marta sanalmasin
+    for handlers in (bot.message_handlers, bot.callback_query_handlers):
+        for h in handlers:
+            if h["function"] not in (route_text, route_callback):
+                h["function"] = _timed_handler(h["function"])
+    metrics.gauge("update_queue_depth", lambda: ingress.depth())
+    metrics.gauge("sender_queue_depth", sender_pool._work_queue.qsize)
+    metrics.gauge("user_cache_size", lambda: user_cache.stats()["size"])
+    metrics.counter("user_cache_hits_total", lambda: user_cache.hits)
+    metrics.counter("user_cache_misses_total", lambda: user_cache.misses)
+
+instrument()
+
+def start_metrics_server(port: int):
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode("utf-8")
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("0.0.0.0", port), Handler)
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    logging.info("metrics on :%s/metrics", port)
 
 def run_bot():
     try:
         bot.delete_webhook(drop_pending_updates=True)
     except Exception as e:
         logging.warning("delete_webhook failed: %s", e)
+    if METRICS_PORT:
+        start_metrics_server(METRICS_PORT)
+    offset = None
     while True:
         try:
-            bot.infinity_polling(
-                skip_pending=True,
-                timeout=20,
-                long_polling_timeout=20,
-                allowed_updates=["message", "callback_query"],
+            updates = apihelper.get_updates(
+                bot.token, offset=offset, timeout=20,
+                long_polling_timeout=20, allowed_updates=ALLOWED_UPDATES,
             )
         except Exception as e:
             logging.exception("polling error: %s", e)
             time.sleep(10)
+            continue
+        for data in updates:
+            offset = data["update_id"] + 1
+            # Navbat to'lsa polling to'xtab turadi
+            ingress.submit(data, block=True)
 
-def run_webhook(app_url: str):
-    try:
-        import json
-        from fastapi import FastAPI, Request
-        import uvicorn
-    except Exception:
-        logging.error("WebHook rejimi uchun fastapi/uvicorn kerak. Iltimos o'rnating.")
-        return
-
-    webhook_url = app_url.rstrip("/") + "/webhook"
-    try:
-        try:
-            bot.delete_webhook(drop_pending_updates=True)
-        except Exception:
-            pass
-        bot.set_webhook(webhook_url)
-        logging.info("Webhook set: %s", webhook_url)
-    except Exception as e:
-        logging.exception("set_webhook failed: %s", e)
+def create_app(on_startup=()):
+    from fastapi import FastAPI, Request, Response
+    from fastapi.responses import PlainTextResponse
 
-    app = FastAPI()
+    app = FastAPI(on_startup=list(on_startup))
 
     @app.get("/")
     def root():
         return {"status": "ok"}
 
+    @app.get("/metrics")
+    def metrics_route():
+        return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
     @app.post("/webhook")
     async def telegram_webhook(req: Request):
+        # Telegram darhol javob oladi; qayta ishlash dispatcher oqimlarida
         payload = await req.body()
         try:
-            update = telebot.types.Update.de_json(payload.decode("utf-8"))
-            bot.process_new_updates([update])
-        except Exception:
-            # Ba’zi hostinglarda request.json kerak bo‘ladi
-            try:
-                data = await req.json()
-                update = telebot.types.Update.de_json(json.dumps(data))
-                bot.process_new_updates([update])
-            except Exception as e:
-                logging.exception("Webhook parse error: %s", e)
+            data = json.loads(payload)
+        except ValueError as e:
+            logging.warning("Webhook parse error: %s", e)
+            return {"ok": True}
+        if not ingress.submit(data):
+            # Navbat to'la: Telegram yangilanishni keyinroq qayta yuboradi
+            return Response(status_code=503, headers={"Retry-After": "1"})
         return {"ok": True}
 
-    uvicorn.run(app, host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
+    return app
+
+def run_webhook(app_url: str, on_startup=()):
+    try:
+        import fastapi  # noqa: F401
+        import uvicorn
+    except Exception:
+        logging.error("WebHook rejimi uchun fastapi/uvicorn kerak. Iltimos o'rnating.")
+        return
+
+    webhook_url = app_url.rstrip("/") + "/webhook"
+
+    def register_webhook():
+        # Server ishga tushishini kutdirmaydi; kutilayotgan yangilanishlar
+        # tashlab yuborilmaydi (uyg'onish aynan ular tufayli bo'lishi mumkin)
+        try:
+            info = bot.get_webhook_info()
+            if info.url != webhook_url or sorted(info.allowed_updates or []) != sorted(ALLOWED_UPDATES):
+                bot.set_webhook(webhook_url, allowed_updates=ALLOWED_UPDATES)
+                logging.info("Webhook set: %s", webhook_url)
+        except Exception as e:
+            logging.exception("set_webhook failed: %s", e)
+
+    threading.Thread(target=register_webhook, name="webhook-setup", daemon=True).start()
+    uvicorn.run(create_app(on_startup), host="0.0.0.0", port=int(os.getenv("PORT", "8080")))
 
 if __name__ == "__main__":
     init_db()
-    start_scheduler_for_all()
+    startup = []
+    if WORKER_PROCESSES > 1:
+        # Asosiy jarayon faqat qabul qiladi va taqsimlaydi
+        db_close_all()
+        ingress = ShardedWorkers(WORKER_PROCESSES, UPDATE_QUEUE_SIZE)
+        ingress.start()
+    else:
+        dispatcher.start()
+        # Scheduler keyin isitiladi: webhook rejimida server tinglay boshlagach
+        startup.append(start_warm_up)
     app_url = os.getenv("APP_URL") or os.getenv("RENDER_EXTERNAL_URL") or os.getenv("RAILWAY_PUBLIC_DOMAIN") or os.getenv("RAILWAY_STATIC_URL")
     if app_url:
-        run_webhook(app_url)
+        run_webhook(app_url, startup)
     else:
+        for fn in startup:
+            fn()
         run_bot()
\ No newline at end of file